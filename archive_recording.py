@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""
+Convert a recording, or a legacy dump, to a compressed archive:
+
+    archive_recording.py recording.rftr archive.rfta [zlib|lzma]
+"""
+
+from pyRFtelemetry.archive import convert_recording, ZLIB, LZMA
+import os
+import sys
+
+
+if __name__ == '__main__':
+    filename, output = sys.argv[1], sys.argv[2]
+    codec = LZMA if len(sys.argv) > 3 and sys.argv[3] == 'lzma' else ZLIB
+    convert_recording(filename, output, codec=codec)
+    print("{}: {} -> {} bytes".format(output, os.path.getsize(filename), os.path.getsize(output)))
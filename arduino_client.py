@@ -23,6 +23,7 @@ This client consumes telemetry data and can feed an arduino via serial port
 
 from pyRFtelemetry.consumers import ArduinoSimpleRelay
 from pyRFtelemetry.network_client import NetworkClient
+from pyRFtelemetry.log_sink import queue_logging
 import logging
 import threading
 import sys
@@ -30,12 +31,11 @@ import serial
 
 
 if __name__ == '__main__':
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(filename)s:%(lineno)s: %(message)s")
     stream_handler = logging.StreamHandler(sys.stderr)
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    # the consumer thread never writes to stderr itself
+    listener = queue_logging(stream_handler)
 
     
     client = NetworkClient("127.0.0.1", port=4580)
@@ -53,4 +53,5 @@ if __name__ == '__main__':
     finally:
         client.shutdown()
         client_thread.join()
+        listener.stop()
         ser.close()
@@ -22,37 +22,11 @@ This client consumes telemetry data and can feed an arduino via serial port
 """
 
 from pyRFtelemetry.consumers import ArduinoSimpleRelay
-from pyRFtelemetry.RFstructs import StructFactory
+from pyRFtelemetry.replay import Replay, ReplayClient
 import serial
-import time
-import matplotlib.pyplot as plt
-import seaborn
+import threading
 
 
-with open('example_data.dat', 'br') as f:
-    data = f.read()
-  
-tags_no_payload = [b"STSS", b'EDSS', b"STRT", b'EDRT']  
-tags_payload = [b'TLMT', b'VHCL', b'SCOR', b'INFO']
-
-recovered = []
-
-place = 0
-
-while place < len(data):
-    if any(tag==data[place:place+4] for tag in tags_no_payload):
-        place += 4
-        continue
-    
-    if any(tag == data[place:place+4] for tag in tags_payload):
-        next_place = place + 4
-        while not any(tag == data[next_place: next_place+4] for tag in tags_no_payload+tags_payload):
-            next_place += 4
-            if next_place > len(data):
-                break
-        recovered.append([data[place:place+4], data[place+4:next_place]])
-        place = next_place   
-
 # separate
 #telemetry = [StructFactory.assemble(tag, payload) for tag, payload in recovered if tag==b'TLMT']
 #vehicles = [StructFactory.assemble(tag, payload) for tag, payload in recovered if tag==b'VHCL']
@@ -71,18 +45,21 @@ while place < len(data):
 
 #
 if __name__ == '__main__':   
-    client = object() # fake socket
-           
     ## open the serial port that your ardiono
     ## is connected to.
     ser = serial.Serial("COM4", 9600, timeout=0.1)
+    client = ReplayClient(Replay('example_data.rftr'))
+    consumer = None
     try:
         consumer = ArduinoSimpleRelay(client, ser)
-        for tag, payload in recovered:
-            consumer.dispatch_message(tag, payload)
-            time.sleep(0.01)
-                
-    except:
-        raise
+        thread = threading.Thread(target=client.run)
+        thread.daemon = True
+        thread.start()
+        # returns once the replay is over
+        consumer.main()
     finally:
-        ser.close()
\ No newline at end of file
+        client.shutdown()
+        if consumer is not None:
+            # stops the thread reading the buttons before the port goes
+            consumer.stop()
+        ser.close()
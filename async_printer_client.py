@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Prints the tags received from one or more rigs, all in one event loop
+
+usage: async_printer_client.py [host:port ...]
+"""
+
+from pyRFtelemetry.async_client import AsyncNetworkClient
+import asyncio
+import logging
+import sys
+
+
+async def print_tags(name, client):
+    async for tag, payload in client:
+        print(name, tag, len(payload))
+
+
+async def main(addresses):
+    clients = []
+    tasks = []
+    for address in addresses:
+        host, _, port = address.partition(':')
+        client = AsyncNetworkClient(host, port=int(port or 4580))
+        clients.append(client)
+        tasks.append(asyncio.ensure_future(client.run()))
+        tasks.append(asyncio.ensure_future(print_tags(address, client)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for client in clients:
+            client.shutdown()
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(filename)s:%(lineno)s: %(message)s")
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    asyncio.run(main(sys.argv[1:] or ["127.0.0.1:4580"]))
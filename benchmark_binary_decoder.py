@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Parse rates of INFO and VHCL payloads with the original BinaryDecoder,
+which builds a format string per call, against the current one using
+cached structs, read_many and memoryview strings.
+"""
+
+from pyRFtelemetry.binary_decoder import BinaryDecoder
+from pyRFtelemetry.RFstructs import VehicleData, InfoData
+from benchmark_decoders import payloads
+from ctypes import sizeof
+import struct
+import timeit
+
+
+class LegacyDecoder:
+    # BinaryDecoder as it was, only what the parsers below use
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read_string(self):
+        len = struct.unpack_from("B", self.data, self.offset)[0]
+        self.offset += 1
+        v = struct.unpack_from("%ds" % len, self.data, self.offset)[0]
+        self.offset += len
+        return v
+
+    def read_char(self):
+        v = struct.unpack_from("B", self.data, self.offset)[0]
+        self.offset += 1
+        return v
+
+    def read_int(self):
+        v = struct.unpack_from("i", self.data, self.offset)[0]
+        self.offset += 4
+        return v
+
+    def read_float(self):
+        v = struct.unpack_from("f", self.data, self.offset)[0]
+        self.offset += 4
+        return v
+
+
+def legacy_info(payload):
+    msg = LegacyDecoder(payload)
+    strings = [msg.read_string() for i in range(3)]
+    return strings, msg.read_float(), msg.read_int(), msg.read_float()
+
+
+def legacy_vhcl(payload):
+    msg = LegacyDecoder(payload)
+    vehicles = []
+    for i in range(msg.read_int()):
+        flags = msg.read_char(), msg.read_char()
+        strings = [msg.read_string() for j in range(3)]
+        total_laps = struct.unpack_from("h", msg.data, msg.offset)[0]
+        msg.offset += sizeof(VehicleData)
+        vehicles.append((flags, strings, total_laps))
+    return vehicles
+
+
+def current_info(payload):
+    msg = BinaryDecoder(payload)
+    strings = [msg.read_string_view() for i in range(3)]
+    return strings, msg.read_many("fif")
+
+
+def current_vhcl(payload):
+    msg = BinaryDecoder(payload)
+    vehicles = []
+    for i in range(msg.read_int()):
+        flags = msg.read_many("BB")
+        strings = [msg.read_string_view() for j in range(3)]
+        total_laps = msg.read_short()
+        msg.offset += sizeof(VehicleData) - 2
+        vehicles.append((flags, strings, total_laps))
+    return vehicles
+
+
+if __name__ == '__main__':
+    data = payloads()
+    for tag, legacy, current in [(b"INFO", legacy_info, current_info),
+                                 (b"VHCL", legacy_vhcl, current_vhcl)]:
+        payload = data[tag]
+        for name, parse in [("legacy", legacy), ("BinaryDecoder", current)]:
+            number = 500 if tag == b"VHCL" else 50000
+            elapsed = min(timeit.repeat(lambda: parse(payload), number=number, repeat=3))
+            print("{} {:14s} {:10.0f} msg/s {:8.2f} us/msg".format(
+                tag.decode('ascii'), name, number / elapsed, elapsed / number * 1e6))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load test of NetworkClient against the fake plugin: TLMT rates from 90 Hz
+to 10 kHz, measuring throughput, latency from the plugin send to the
+consumer dispatch, and messages lost on the way.
+
+'skipped' are messages the plugin did not send because the client had
+not asked for more yet, 'dropped' were sent but never dispatched.
+
+usage: benchmark_client.py [seconds per run]
+"""
+
+from pyRFtelemetry.fake_plugin import FakePluginServer, SyntheticSource, stamp, stamp_offset
+from pyRFtelemetry.network_client import NetworkClient, LATEST, QUEUE
+from pyRFtelemetry.consumers import DataConsumer
+import collections
+import sys
+import threading
+import time
+
+
+class LatencyProbe(DataConsumer):
+    def __init__(self, client):
+        DataConsumer.__init__(self, client, wait_timeout=0.1)
+        self.received = collections.Counter()
+        self.latencies = []
+
+    def dispatch_message(self, tag, payload):
+        self.received[tag] += 1
+        if tag == b"TLMT":
+            sent = stamp.unpack_from(payload, stamp_offset)[0]
+            self.latencies.append(time.monotonic() - sent)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(rate, mode, duration, honor_keepalive):
+    source = SyntheticSource(rate=rate, grid_size=40, duration=duration)
+    server = FakePluginServer(source, honor_keepalive=honor_keepalive, stamp=True)
+    client = NetworkClient(server.host, server.port, mode=mode, queue_size=100000)
+    probe = LatencyProbe(client)
+    client_thread = threading.Thread(target=client.run)
+    client_thread.daemon = True
+    server_thread = server.start()
+    client_thread.start()
+    probe_thread = threading.Thread(target=probe.main)
+    probe_thread.start()
+    start = time.monotonic()
+    server.finished.wait()
+    time.sleep(0.2)
+    elapsed = time.monotonic() - start
+    probe.stop()
+    probe_thread.join()
+    client.shutdown()
+    server.shutdown()
+    server_thread.join()
+
+    latencies = sorted(probe.latencies)
+    sent = server.sent.get(b"TLMT", 0)
+    received = probe.received[b"TLMT"]
+    print("{:6d} Hz {:6s} keepalive={:d} TLMT sent {:7d} skipped {:7d} dropped {:7d} "
+          "| {:8.0f} msg/s | latency ms p50 {:6.2f} p90 {:6.2f} p99 {:6.2f} max {:7.2f}".format(
+              rate, mode, honor_keepalive, sent, server.skipped.get(b"TLMT", 0),
+              sent - received, sum(probe.received.values()) / elapsed,
+              percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.9) * 1e3,
+              percentile(latencies, 0.99) * 1e3, (latencies[-1] if latencies else float('nan')) * 1e3))
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    for rate in [90, 1000, 10000]:
+        for mode in [LATEST, QUEUE]:
+            for honor_keepalive in [True, False]:
+                run(rate, mode, duration, honor_keepalive)
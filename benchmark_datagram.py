@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""
+Serialize and validate rates of the arduino datagrams with the original
+ctypes copy and Python XOR loop against the current checksum, and the
+rate of UpstreamDatagram.scan over a raw stream.
+"""
+
+from pyRFtelemetry.serial_link import (DownstreamDatagram, UpstreamDatagram,
+                                       header1, header2)
+from ctypes import c_byte, sizeof, memmove
+import ctypes
+import timeit
+
+
+def legacy_serialize(datagram):
+    buf = (c_byte*(sizeof(datagram)-1))()
+    memmove(buf, ctypes.byref(datagram), sizeof(datagram)-1)
+    datagram.check = buf[0]
+    for b2 in buf[1:]:
+        datagram.check ^= b2
+    return ctypes.string_at(ctypes.byref(datagram), ctypes.sizeof(datagram))
+
+
+def legacy_is_valid(datagram):
+    buf = (c_byte*(sizeof(datagram)-1))()
+    memmove(buf, ctypes.byref(datagram), sizeof(datagram)-1)
+    check = buf[0]
+    for b2 in buf[1:]:
+        check ^= b2
+    return True if datagram.check == check else False
+
+
+def legacy_scan(data):
+    # what read_upstream did, one datagram at a time
+    found = []
+    size = sizeof(UpstreamDatagram)
+    for offset in range(0, len(data) - size + 1, size):
+        datagram = UpstreamDatagram()
+        datagram.from_bytes(data[offset:offset + size])
+        if legacy_is_valid(datagram):
+            found.append(datagram)
+    return found
+
+
+def rate(name, func, number):
+    elapsed = min(timeit.repeat(func, number=number, repeat=3))
+    print("{:28s} {:12.0f} /s {:8.3f} us".format(name, number / elapsed, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    down = DownstreamDatagram()
+    down.header1 = header1
+    down.header2 = header2
+    down.screen_from_string("12 4 187")
+    down.fuel = 55
+    out = bytearray(sizeof(down))
+
+    up = UpstreamDatagram()
+    up.header1 = header1
+    up.header2 = header2
+    up.buttons1 = 4
+    stream = up.serialize() * 1000
+
+    rate("serialize legacy", lambda: legacy_serialize(down), 100000)
+    rate("serialize", down.serialize, 100000)
+    rate("serialize_into", lambda: down.serialize_into(out), 100000)
+    rate("is_valid legacy", lambda: legacy_is_valid(up), 100000)
+    rate("is_valid", up.is_valid, 100000)
+    rate("1000 upstream legacy", lambda: legacy_scan(stream), 50)
+    rate("1000 upstream scan", lambda: UpstreamDatagram.scan(stream), 50)
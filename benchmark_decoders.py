@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Decode plus field access rates of the ctypes StructFactory against the
+RecordFactory for TLMT, SCOR, INFO and VHCL payloads. AllRecords decodes
+every tag into the precompiled records, which RecordFactory only does
+for SCOR and INFO.
+
+'few' reads the handful of fields a dashboard needs, 'all' reads every
+field once, as a logger or an analysis tool would.
+"""
+
+from pyRFtelemetry.RFstructs import (StructFactory, RecordFactory, LazyFactory, TelemetryData,
+                                     ScoreData, InfoData, VehicleData, compile_decoder,
+                                     decoders)
+from ctypes import sizeof
+import os
+import struct
+import timeit
+
+
+class AllRecords(RecordFactory):
+    @staticmethod
+    def build(structure, data, offset=0, extra=()):
+        if extra:
+            return decoders[structure](data, offset, extra)
+        return decoders[structure](data, offset)
+
+
+def pascal(string):
+    return struct.pack("B", len(string)) + string
+
+
+def payloads(num_vehicles=40):
+    info = pascal(b"Monza") + pascal(b"Player") + pascal(b"player.PLR") + os.urandom(sizeof(InfoData))
+    vhcl = [struct.pack("i", num_vehicles)]
+    for i in range(num_vehicles):
+        vhcl.append(struct.pack("BB", i == 0, 0))
+        vhcl.append(pascal(b"Driver %d" % i) + pascal(b"Car %d" % i) + pascal(b"GT"))
+        vhcl.append(os.urandom(sizeof(VehicleData)))
+    return {
+        b"TLMT": os.urandom(sizeof(TelemetryData)),
+        b"SCOR": os.urandom(sizeof(ScoreData)),
+        b"INFO": info,
+        b"VHCL": b"".join(vhcl),
+    }
+
+
+def read_all(st):
+    if isinstance(st, list):
+        return [read_all(v) for v in st]
+    values = []
+    for name, ctype in st._fields_ if hasattr(st, '_fields_') else st.structure._fields_:
+        value = getattr(st, name)
+        if name == 'wheels':
+            value = [read_all(wheel) for wheel in value]
+        values.append(value)
+    return values
+
+
+def read_few(tag, st):
+    if tag == b"TLMT":
+        return (st.engine_rpm / (st.max_engine_rpm or 1), st.velocity[2], st.gear,
+                st.fuel, st.wheels[0].temperatures[1], st.wheels[3].wear)
+    elif tag == b"SCOR":
+        return st.current_ET, st.wind[0], st.session
+    elif tag == b"INFO":
+        return st.track_name, st.lap_distance, st.max_laps
+    else:
+        return [(v.is_player, v.total_laps, v.last_lap_time, v.position[0]) for v in st]
+
+
+def check_empty_grid():
+    # a VHCL without vehicles is valid, every decoder has to take it
+    empty = struct.pack("i", 0)
+    for factory in [StructFactory, RecordFactory, LazyFactory]:
+        assert list(factory.assemble(b"VHCL", empty)) == [], factory
+    grid = StructFactory.assemble_grid(empty)
+    assert len(grid) == 0 and grid.player_index is None and grid.player() is None
+    assert grid['position'].shape == (0, 3) and grid.names() == []
+
+
+if __name__ == '__main__':
+    check_empty_grid()
+    data = payloads()
+    for tag, payload in data.items():
+        for pattern in ['few', 'all']:
+            for factory in [StructFactory, RecordFactory, AllRecords, LazyFactory]:
+                if pattern == 'few':
+                    run = lambda: read_few(tag, factory.assemble(tag, payload))
+                else:
+                    run = lambda: read_all(factory.assemble(tag, payload))
+                number = 200 if tag == b"VHCL" else 20000
+                elapsed = min(timeit.repeat(run, number=number, repeat=3))
+                print("{} {} {:14s} {:10.0f} msg/s {:8.2f} us/msg".format(
+                    tag.decode('ascii'), pattern, factory.__name__,
+                    number / elapsed, elapsed / number * 1e6))
+
+    # columnar VHCL decode, reading the same fields as read_few
+    def grid_few():
+        grid = StructFactory.assemble_grid(data[b"VHCL"])
+        return (grid.player(), grid['total_laps'], grid['last_lap_time'], grid['position'][:, 0])
+    elapsed = min(timeit.repeat(grid_few, number=200, repeat=3))
+    print("VHCL few {:14s} {:10.0f} msg/s {:8.2f} us/msg".format(
+        "VehicleGrid", 200 / elapsed, elapsed / 200 * 1e6))
+
+    # TLMT decoding only the fields read, as a consumer declaring them does
+    decode = compile_decoder(TelemetryData, ("engine_rpm", "max_engine_rpm", "velocity", "gear", "fuel"))
+    def fields_few():
+        st = decode(data[b"TLMT"])
+        return st.engine_rpm / (st.max_engine_rpm or 1), st.velocity[2], st.gear, st.fuel
+    elapsed = min(timeit.repeat(fields_few, number=20000, repeat=3))
+    print("TLMT few {:14s} {:10.0f} msg/s {:8.2f} us/msg".format(
+        "fields", 20000 / elapsed, elapsed / 20000 * 1e6))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Throughput of the NetworkClient framing: legacy bytes concatenation
+against ReceiveBuffer. The stream is fed in recv sized chunks and parsed
+every `backlog` chunks, emulating a consumer that falls behind.
+"""
+
+from pyRFtelemetry.network_client import ReceiveBuffer
+from pyRFtelemetry.RFstructs import TelemetryData, ScoreData
+from ctypes import sizeof
+import struct
+import time
+
+
+def make_stream(nframes):
+    tlmt = struct.pack("4sI", b"TLMT", sizeof(TelemetryData) + 8) + bytes(sizeof(TelemetryData))
+    scor = struct.pack("4sI", b"SCOR", sizeof(ScoreData) + 8) + bytes(sizeof(ScoreData))
+    vhcl = struct.pack("4sI", b"VHCL", 3000 + 8) + bytes(3000)
+    frames = []
+    for i in range(nframes):
+        frames.append(tlmt)
+        if i % 45 == 0:
+            frames.append(scor)
+            frames.append(vhcl)
+    return b"".join(frames)
+
+
+def chunks(stream, size=4096):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def legacy(pieces, backlog):
+    new_data = {}
+    stream = b""
+    count = 0
+    for n, piece in enumerate(pieces, 1):
+        stream += piece
+        if n % backlog:
+            continue
+        while len(stream) >= 8:
+            tag, size = struct.unpack_from("4sI", stream)
+            if len(stream) < size:
+                break
+            payload = stream[8:size]
+            stream = stream[size:]
+            new_data[tag] = payload
+            count += 1
+    return count
+
+
+def ring(pieces, backlog):
+    new_data = {}
+    rbuf = ReceiveBuffer()
+    count = 0
+    for n, piece in enumerate(pieces, 1):
+        # emulate recv_into
+        view = rbuf.writable()
+        nbytes = min(len(view), len(piece))
+        view[0:nbytes] = piece[0:nbytes]
+        rbuf.commit(nbytes)
+        if nbytes < len(piece):
+            view = rbuf.writable()
+            view[0:len(piece) - nbytes] = piece[nbytes:]
+            rbuf.commit(len(piece) - nbytes)
+        if n % backlog:
+            continue
+        for tag, payload in rbuf.frames():
+            new_data[tag] = payload
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    stream = make_stream(20000)
+    pieces = chunks(stream)
+    print("{} bytes in {} chunks".format(len(stream), len(pieces)))
+    for backlog in [1, 16, 128]:
+        for name, impl in [("legacy", legacy), ("ReceiveBuffer", ring)]:
+            start = time.perf_counter()
+            count = impl(pieces, backlog)
+            elapsed = time.perf_counter() - start
+            print("backlog {:4d} {:14s} {:8d} frames {:8.1f} MB/s {:10.0f} frames/s".format(
+                backlog, name, count, len(stream) / elapsed / 1e6, count / elapsed))
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""
+Build the TrackIndex of a track from a lap of a recording:
+
+    build_track_index.py recording.rftr lap track.npz
+"""
+
+from pyRFtelemetry.recording import RecordingReader
+from pyRFtelemetry.track import TrackIndex
+import sys
+
+
+if __name__ == '__main__':
+    filename, lap, output = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    with RecordingReader(filename) as recording:
+        index = TrackIndex.from_recording(recording, lap)
+    index.save(output)
+    print("{}: {:.0f} m, {} segments, {}x{} cells".format(
+        output, index.length, len(index.points) - 1, index.shape[0], index.shape[1]))
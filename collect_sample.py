@@ -43,9 +43,10 @@ if __name__ == '__main__':
     client_thread.daemon = True
     client_thread.start()
               
-    consumer = FileDump(client, 'example_data.dat')
+    consumer = FileDump(client, 'example_data.rftr')
     try:
         consumer.main()
     finally:
         client.shutdown()
         client_thread.join()
+        consumer.close()
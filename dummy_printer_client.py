@@ -20,17 +20,17 @@
 
 from pyRFtelemetry.consumers import DebugPrinter
 from pyRFtelemetry.network_client import NetworkClient
+from pyRFtelemetry.log_sink import queue_logging
 import logging
 import threading
 import sys
 
 if __name__ == '__main__':
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(filename)s:%(lineno)s: %(message)s")
     stream_handler = logging.StreamHandler(sys.stderr)
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    # the consumer thread never writes to stderr itself
+    listener = queue_logging(stream_handler)
 
     
     client = NetworkClient("127.0.0.1", port=4580)
@@ -44,3 +44,4 @@ if __name__ == '__main__':
     finally:
         client.shutdown()
         client_thread.join()
+        listener.stop()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serves made up or recorded telemetry on the plugin port, so that the
+clients can run without rFactor
+
+usage: fake_plugin_server.py [port] [TLMT rate] [grid size]
+       fake_plugin_server.py [port] [recording]
+"""
+
+from pyRFtelemetry.fake_plugin import FakePluginServer, SyntheticSource, recording_source
+import logging
+import os
+import sys
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(filename)s:%(lineno)s: %(message)s")
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+    logger.addHandler(stream_handler)
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 4580
+    if len(sys.argv) > 2 and os.path.exists(sys.argv[2]):
+        source = recording_source(sys.argv[2])
+    else:
+        rate = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+        grid_size = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+        source = SyntheticSource(rate=rate, grid_size=grid_size)
+
+    server = FakePluginServer(source, host="0.0.0.0", port=port)
+    try:
+        server.run()
+    finally:
+        server.shutdown()
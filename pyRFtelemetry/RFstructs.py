@@ -16,59 +16,80 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from ctypes import Structure, c_int, c_uint8, c_float, c_char, c_short, c_byte, sizeof
+from ctypes import Structure, Array, c_int, c_uint8, c_float, c_char, c_short, c_byte, sizeof
 from .binary_decoder import BinaryDecoder
+from collections import namedtuple
+import logging
+import struct
+
+class LifecycleEvent(object):
+    """Session and realtime transitions, their tags carry no payload"""
+    tag = None
+
+    def __repr__(self):
+        return "<{}>".format(type(self).__name__)
+
+
+class StartSession(LifecycleEvent):
+    tag = b"STSS"
+
+
+class EndSession(LifecycleEvent):
+    tag = b"EDSS"
+
+
+class StartRealtime(LifecycleEvent):
+    tag = b"STRT"
+
+
+class EndRealtime(LifecycleEvent):
+    tag = b"EDRT"
+
+
+lifecycle_events = dict((event.tag, event) for event in
+                        [StartSession, EndSession, StartRealtime, EndRealtime])
+
 
 class StructFactory(object):
     @staticmethod
-    def assemble(tag, payload):                  
+    def build(structure, data, offset=0, extra=()):
+        st = structure.from_buffer_copy(data, offset)
+        #hook the variable length part (strings)
+        for name, value in zip(getattr(structure, '_extra_', ()), extra):
+            setattr(st, name, value)
+        return st
+
+    @classmethod
+    def assemble(cls, tag, payload):                  
         if tag == b"TLMT":
-            return TelemetryData.from_buffer_copy(payload)
+            return cls.build(TelemetryData, payload)
         elif tag == b"SCOR":
-            return ScoreData.from_buffer_copy(payload)
+            return cls.build(ScoreData, payload)
         elif tag == b"INFO":
             msg = BinaryDecoder(payload) 
             track_name=msg.read_string()
             player_name = msg.read_string()
             prl_file = msg.read_string()
-            infostruct = InfoData.from_buffer_copy(msg.data[msg.offset:])
-            #hook the variable length part (strings)
-            infostruct.track_name = track_name
-            infostruct.player_name = player_name
-            infostruct.prl_file = prl_file
-            return infostruct
-            
-        elif tag == b"STSS":
-            print("[start_session]")
-        elif tag == b"EDSS":
-            print("[end_session]")
-        elif tag == b"STRT":
-            print("[start_realtime]")
-        elif tag == b"EDRT":
-            print("[end_realtime]")
+            return cls.build(InfoData, msg.data, msg.offset,
+                             (track_name, player_name, prl_file))
+
+        elif tag in lifecycle_events:
+            return lifecycle_events[tag]()
         elif tag == b"VHCL":           
             msg = BinaryDecoder(payload)
             num_vehicles = msg.read_int()
-            #print("info.mNumVehicles", num_vehicles)
             
             vehicles = []
     
             for i in range(0, num_vehicles):               
-                is_player = msg.read_char()
-                player_control = msg.read_char()
+                is_player, player_control = msg.read_many("BB")
                 driver_name = msg.read_string()
                 vehicle_name = msg.read_string()
                 vehicle_class = msg.read_string()
                 
-                vinfo = VehicleData.from_buffer_copy(
-                    msg.data[msg.offset : msg.offset+sizeof(VehicleData)]
-                    )
-                #hook the variable length part (strings)
-                vinfo.is_player = is_player
-                vinfo.player_control = player_control
-                vinfo.driver_name = driver_name
-                vinfo.vehicle_name = vehicle_name
-                vinfo.vehicle_class = vehicle_class
+                vinfo = cls.build(VehicleData, msg.data, msg.offset,
+                                  (is_player, player_control, driver_name,
+                                   vehicle_name, vehicle_class))
                 #fix the offset of the decoder
                 msg.offset+=sizeof(VehicleData)
                 
@@ -77,15 +98,122 @@ class StructFactory(object):
             return vehicles
             
         else:
-            print("error: unknown tag: {}".format(tag))           
+            logging.warning("unknown tag: %s", tag)
         return None
 
+    @staticmethod
+    def assemble_array(tag, payloads):
+        """Decode a run of payloads of a fixed size tag (TLMT, SCOR) into one
+        NumPy structured array"""
+        return fixed_size_tags[tag].from_payloads(payloads)
+
+    @staticmethod
+    def assemble_grid(payload):
+        """Decode a VHCL payload into a columnar VehicleGrid"""
+        return VehicleGrid(payload)
+
+
+class RecordFactory(StructFactory):
+    """Same as StructFactory, but SCOR and INFO decode into the records of
+    the precompiled decoders, which are quicker to build and to read.
+
+    TLMT and VHCL stay ctypes structures: unpacking all of their values up
+    front costs more than the copy ctypes makes, and they are rarely read
+    whole (see benchmark_decoders.py). A consumer reading a few TLMT fields
+    declares them instead, see DataConsumer.fields.
+    """
+    @classmethod
+    def assemble(cls, tag, payload):
+        if tag == b"TLMT" or tag == b"VHCL":
+            return StructFactory.assemble(tag, payload)
+        return super(RecordFactory, cls).assemble(tag, payload)
+
+    @staticmethod
+    def build(structure, data, offset=0, extra=()):
+        decoder = record_decoders.get(structure)
+        if decoder is None:
+            return StructFactory.build(structure, data, offset, extra)
+        if extra:
+            return decoder(data, offset, extra)
+        return decoder(data, offset)
+
+
+class LazyFactory(StructFactory):
+    """Same as StructFactory, but VHCL decodes into a list of LazyStructs
+    that only unpack the fields actually read. The other tags stay ctypes
+    structures, which already convert a field only when it is read."""
+    @classmethod
+    def assemble(cls, tag, payload):
+        if tag != b"VHCL":
+            return super(LazyFactory, cls).assemble(tag, payload)
+        # only follow the string lengths, the strings are read on demand
+        size = sizeof(VehicleData)
+        vehicles = []
+        pos = 4
+        for i in range(struct.unpack_from("<i", payload)[0]):
+            strings = pos + 2
+            pos = strings
+            pos += 1 + payload[pos]
+            pos += 1 + payload[pos]
+            pos += 1 + payload[pos]
+            vehicles.append(LazyStruct(VehicleData, payload, pos, strings))
+            pos += size
+        return vehicles
+
+
+_dtypes = {
+    c_float: '<f4',
+    c_int: '<i4',
+    c_uint8: 'u1',
+    c_char: 'S1',
+    c_short: '<i2',
+    c_byte: 'i1',
+}
+
 class EnhancedStructure(Structure):
+    @classmethod
+    def dtype(cls):
+        """Packed NumPy structured dtype with the layout of _fields_"""
+        if '_dtype' not in cls.__dict__:
+            import numpy as np
+            fields = []
+            for name, ctype in cls._fields_:
+                if issubclass(ctype, Array) and ctype._type_ is c_char:
+                    fields.append((name, 'S%d' % ctype._length_))
+                elif issubclass(ctype, Array):
+                    base = ctype._type_
+                    base = base.dtype() if issubclass(base, Structure) else _dtypes[base]
+                    fields.append((name, base, (ctype._length_,)))
+                elif issubclass(ctype, Structure):
+                    fields.append((name, ctype.dtype()))
+                else:
+                    fields.append((name, _dtypes[ctype]))
+            cls._dtype = np.dtype(fields)
+            assert cls._dtype.itemsize == sizeof(cls), cls
+        return cls._dtype
+
+    @classmethod
+    def from_payloads(cls, payloads):
+        """Decode payloads of this structure into one structured array.
+
+        `payloads` is an iterable of payloads or a single buffer holding
+        them back to back, which is then used without copying.
+        """
+        import numpy as np
+        if isinstance(payloads, (bytes, bytearray, memoryview)):
+            data = payloads
+        else:
+            data = b"".join(payloads)
+        if len(data) % sizeof(cls):
+            raise ValueError("{} bytes is not a whole number of {}".format(len(data), cls.__name__))
+        return np.frombuffer(data, dtype=cls.dtype())
+
     def numpyfy(self):
-        pass
+        import numpy as np
+        return np.frombuffer(bytes(self), dtype=self.dtype())[0]
 
 
-class WheelData(Structure):
+class WheelData(EnhancedStructure):
     _fields_ = [
         ("rotation", c_float),
         ("suspension_deflection", c_float),
@@ -103,7 +231,7 @@ class WheelData(Structure):
         ]
     _pack_=1
 
-class TelemetryData(Structure):
+class TelemetryData(EnhancedStructure):
     _fields_ = [
         ("delta_time", c_float),
         ("lap_number", c_int),
@@ -139,8 +267,9 @@ class TelemetryData(Structure):
         ]
     _pack_=1
 
-class VehicleData(Structure):
+class VehicleData(EnhancedStructure):
     #variable length strings are hooked later
+    _extra_ = ("is_player", "player_control", "driver_name", "vehicle_name", "vehicle_class")
     _fields_ = [
     ("total_laps" , c_short),
     ("sector", c_uint8),
@@ -178,7 +307,7 @@ class VehicleData(Structure):
     
 
     
-class ScoreData(Structure):
+class ScoreData(EnhancedStructure):
     _fields_ = [
         ("game_phase", c_char),
         ("yellow_flag", c_char),
@@ -200,13 +329,273 @@ class ScoreData(Structure):
         ]
     _pack_=1
     
-class InfoData(Structure):
+class InfoData(EnhancedStructure):
     #variable length strings are hooked later
+    _extra_ = ("track_name", "player_name", "prl_file")
     _fields_ = [
         ("end_ET", c_float),
         ("max_laps", c_int),
         ("lap_distance", c_float)
     ]
     _pack_=1
-    
 
+
+_formats = {
+    c_float: 'f',
+    c_int: 'i',
+    c_uint8: 'B',
+    c_char: 'c',
+    c_short: 'h',
+    c_byte: 'b',
+}
+
+_records = {}
+
+def record_class(structure, fields=None):
+    """Return the named tuple record matching a ctypes structure.
+
+    The names in _extra_ come first, then _fields_, or only the ones in
+    `fields`. Arrays are tuples and nested structures are records too.
+    """
+    key = structure if fields is None else (structure, tuple(fields))
+    if key not in _records:
+        name = structure.__name__.replace('Data', '')
+        names = [name for name, ctype in structure._fields_]
+        if fields is None:
+            name += 'Record'
+        else:
+            unknown = set(fields) - set(names)
+            if unknown:
+                raise ValueError("{} has no fields {}".format(structure.__name__, sorted(unknown)))
+            name += 'Fields'
+            names = [name for name in names if name in fields]
+        _records[key] = namedtuple(name, tuple(getattr(structure, '_extra_', ())) + tuple(names))
+        _records[key].structure = structure
+    return _records[key]
+
+def _layout(structure, index, fields=None):
+    """Return the struct format of a structure and the source of the
+    expression building its record from the unpacked values v[index:].
+    Fields not in `fields` are skipped as pad bytes."""
+    fmt = []
+    args = ['e[%d]' % i for i in range(len(getattr(structure, '_extra_', ())))]
+    for name, ctype in structure._fields_:
+        if fields is not None and name not in fields:
+            fmt.append('%dx' % sizeof(ctype))
+        elif issubclass(ctype, Array) and ctype._type_ is c_char:
+            fmt.append('%ds' % ctype._length_)
+            args.append('v[%d]' % index)
+            index += 1
+        elif issubclass(ctype, Array) and ctype._type_ in _formats:
+            fmt.append(_formats[ctype._type_] * ctype._length_)
+            args.append('v[%d:%d]' % (index, index + ctype._length_))
+            index += ctype._length_
+        elif issubclass(ctype, Array):
+            items = []
+            for i in range(ctype._length_):
+                sub_fmt, sub_expr, index = _layout(ctype._type_, index)
+                fmt.append(sub_fmt)
+                items.append(sub_expr)
+            args.append('(%s,)' % ', '.join(items))
+        elif issubclass(ctype, Structure):
+            sub_fmt, sub_expr, index = _layout(ctype, index)
+            fmt.append(sub_fmt)
+            args.append(sub_expr)
+        else:
+            fmt.append(_formats[ctype])
+            args.append('v[%d]' % index)
+            index += 1
+    expr = 'new(%s, (%s,))' % (record_class(structure, fields).__name__, ', '.join(args))
+    return ''.join(fmt), expr, index
+
+def compile_decoder(structure, fields=None):
+    """Build a decoder(data, offset=0, extra=()) -> record for a packed
+    ctypes structure. The whole layout, nested structures included, is
+    unpacked by one struct.Struct compiled from _fields_ and the record
+    is built by generated code, `extra` fills the _extra_ names. With
+    `fields` only those are unpacked, into a smaller record."""
+    fmt, expr, count = _layout(structure, 0, fields)
+    unpacker = struct.Struct('<' + fmt)
+    assert unpacker.size == sizeof(structure), structure
+    namespace = dict((r.__name__, r) for r in _records.values())
+    record = record_class(structure, fields)
+    namespace[record.__name__] = record
+    namespace['new'] = tuple.__new__
+    namespace['unpack_from'] = unpacker.unpack_from
+    blank = (None,) * len(getattr(structure, '_extra_', ()))
+    source = 'def decode(data, offset=0, e=%r):\n' % (blank,)
+    source += '    v = unpack_from(data, offset)\n'
+    source += '    return %s\n' % expr
+    exec(source, namespace)
+    decoder = namespace['decode']
+    decoder.size = unpacker.size
+    decoder.unpacker = unpacker
+    return decoder
+
+
+_lazy_fields = {}
+
+def lazy_fields(structure):
+    """Return name -> (unpack_from, offset, single) for the fields of a
+    structure that can be unpacked on their own: scalars and arrays of
+    scalars. Char arrays and nested structures are left out."""
+    if structure not in _lazy_fields:
+        fields = {}
+        for name, ctype in structure._fields_:
+            offset = getattr(structure, name).offset
+            if issubclass(ctype, Array) and ctype._type_ in _formats and ctype._type_ is not c_char:
+                fmt = _formats[ctype._type_] * ctype._length_
+                fields[name] = (struct.Struct('<' + fmt).unpack_from, offset, False)
+            elif not issubclass(ctype, (Array, Structure)):
+                fields[name] = (struct.Struct('<' + _formats[ctype]).unpack_from, offset, True)
+        _lazy_fields[structure] = fields
+    return _lazy_fields[structure]
+
+
+class LazyStruct(object):
+    """Stands for a structure decoded from data[offset:].
+
+    Scalar fields and arrays of scalars are unpacked from the payload when
+    read, anything else decodes the whole structure once with
+    StructFactory.build. isinstance checks against the structure hold.
+    Every read unpacks again, so it pays off when few fields of many
+    structures are read, as with the vehicles of a VHCL.
+    `extra` fills the _extra_ names, for VHCL it can be the position of the
+    flags and strings of the vehicle instead, read when first needed.
+    """
+    __slots__ = ('structure', 'data', 'offset', 'extra', '_fields', '_full')
+
+    def __init__(self, structure, data, offset=0, extra=()):
+        self.structure = structure
+        self.data = data
+        self.offset = offset
+        self.extra = extra
+        self._fields = _lazy_fields.get(structure) or lazy_fields(structure)
+        self._full = None
+
+    @property
+    def __class__(self):
+        return self.structure
+
+    def __getattr__(self, name):
+        field = self._fields.get(name)
+        if field is not None:
+            value = field[0](self.data, self.offset + field[1])
+            return value[0] if field[2] else value
+        names = getattr(self.structure, '_extra_', ())
+        if name in names:
+            index = names.index(name)
+            if index < 2 and isinstance(self.extra, int):
+                # VHCL flags, no need to read the strings
+                return self.data[self.extra - 2 + index]
+            return self.extras()[index]
+        return getattr(self.decode(), name)
+
+    def extras(self):
+        if isinstance(self.extra, int):
+            self.extra = _vehicle_extra(self.data, self.extra)
+        return self.extra
+
+    def decode(self):
+        """The whole structure as StructFactory builds it"""
+        if self._full is None:
+            self._full = StructFactory.build(self.structure, self.data, self.offset, self.extras())
+        return self._full
+
+
+def _vehicle_extra(payload, pos):
+    # is_player, player_control, then the 3 strings of a VHCL vehicle
+    extra = [payload[pos - 2], payload[pos - 1]]
+    for i in range(3):
+        extra.append(bytes(payload[pos + 1:pos + 1 + payload[pos]]))
+        pos += 1 + payload[pos]
+    return tuple(extra)
+
+
+class VehicleGrid(object):
+    """Columnar decode of a VHCL payload.
+
+    One pass over the payload only follows the string lengths to find where
+    each vehicle starts, then all the VehicleData blocks are gathered into
+    the structured array `data` at once. is_player and player_control are
+    arrays alongside it, the strings are only sliced out when asked for.
+    """
+    string_fields = ("driver_name", "vehicle_name", "vehicle_class")
+
+    def __init__(self, payload):
+        import numpy as np
+        num_vehicles = struct.unpack_from("<i", payload)[0]
+        size = sizeof(VehicleData)
+        starts = []
+        strings = []
+        pos = 4
+        for i in range(num_vehicles):
+            starts.append(pos)
+            pos += 2
+            strings.append(pos)
+            pos += 1 + payload[pos]
+            pos += 1 + payload[pos]
+            pos += 1 + payload[pos]
+            pos += size
+        if pos > len(payload):
+            raise ValueError("truncated VHCL payload")
+        self.payload = payload
+        self.raw = np.frombuffer(payload, dtype=np.uint8)
+        self.starts = np.array(starts, dtype=np.intp)
+        self.is_player = self.raw[self.starts]
+        self.player_control = self.raw[self.starts + 1]
+        if num_vehicles:
+            # the fixed size block follows the strings, ending at the next start
+            ends = np.append(self.starts[1:], pos)
+            rows = self.raw[(ends - size)[:, None] + np.arange(size)]
+            self.data = rows.view(VehicleData.dtype()).reshape(num_vehicles)
+        else:
+            self.data = np.empty(0, dtype=VehicleData.dtype())
+        self._strings = strings
+        self._names = {}
+        players = np.flatnonzero(self.is_player)
+        self.player_index = int(players[0]) if len(players) else None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        if name in self.string_fields:
+            return self.names(name)
+        return self.data[name]
+
+    def names(self, field="driver_name"):
+        """List of one of the string fields, as bytes, for all vehicles"""
+        if field not in self._names:
+            skip = self.string_fields.index(field)
+            payload = self.payload
+            names = []
+            for pos in self._strings:
+                for i in range(skip):
+                    pos += 1 + payload[pos]
+                names.append(bytes(payload[pos + 1:pos + 1 + payload[pos]]))
+            self._names[field] = names
+        return self._names[field]
+
+    def player(self):
+        """Structured row of the player vehicle, None if there is none"""
+        if self.player_index is None:
+            return None
+        return self.data[self.player_index]
+
+
+fixed_size_tags = {
+    b"TLMT": TelemetryData,
+    b"SCOR": ScoreData,
+}
+
+WheelRecord = record_class(WheelData)
+TelemetryRecord = record_class(TelemetryData)
+VehicleRecord = record_class(VehicleData)
+ScoreRecord = record_class(ScoreData)
+InfoRecord = record_class(InfoData)
+
+decoders = dict((structure, compile_decoder(structure)) for structure in
+                [WheelData, TelemetryData, VehicleData, ScoreData, InfoData])
+# the structures RecordFactory decodes into records
+record_decoders = dict((structure, decoders[structure]) for structure in [ScoreData, InfoData])
@@ -0,0 +1,605 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compressed columnar archives of the plugin stream, for long term storage
+
+An archive is a file header, chunks and, once the writer is closed, an
+index followed by a footer pointing at it:
+
+    header  "RFTA", version (H), flags (H), wall clock start time (d)
+    chunk   tag (4s), source id (H), codec (B), rows (I), min and max lap
+            (ii), min and max time (dd), body size (I), compressed body
+    index   sources: count (H), then a Pascal string per source
+            chunks: count (I), then per chunk its offset (Q) and header
+    footer  index offset (Q), "RFAI"
+
+A chunk holds the messages of one tag and source. Its body is the rows
+as columns: receive time and lap of every row, then the fields of the
+RFstructs layout, floats XORed with the previous row, integers as
+differences, each column split in byte planes. TLMT and SCOR have a row
+per message. VHCL has the time, lap and number of vehicles of every
+message, then a row per vehicle and a table of the driver strings, so
+messages without vehicles are kept too. Other tags are kept as raw
+payloads.
+
+As with recordings, an archive without footer is read by walking the
+chunks.
+"""
+
+from array import array
+from collections import namedtuple
+from ctypes import sizeof
+import lzma
+import logging
+import mmap
+import struct
+import time
+import zlib
+
+from .RFstructs import TelemetryData, ScoreData, VehicleData
+from .binary_decoder import BinaryDecoder
+
+MAGIC = b"RFTA"
+INDEX_MAGIC = b"RFAI"
+VERSION = 2
+
+# codecs
+NONE = 0
+ZLIB = 1
+LZMA = 2
+
+file_header = struct.Struct("<4sHHd")
+chunk_header = struct.Struct("<4sHBIiiddI")
+chunk_entry = struct.Struct("<Q4sHBIiiddI")
+footer = struct.Struct("<Q4s")
+
+Chunk = namedtuple('Chunk', 'offset tag source codec rows lap_min lap_max time_min time_max size')
+Frames = namedtuple('Frames', 'times laps data')
+Vehicles = namedtuple('Vehicles', 'times laps data frame is_player player_control driver names '
+                                   'frame_times frame_laps counts')
+Payloads = namedtuple('Payloads', 'times laps payloads')
+
+column_tags = {
+    b"TLMT": TelemetryData,
+    b"SCOR": ScoreData,
+}
+
+_compressors = {
+    NONE: lambda data, level: data,
+    ZLIB: lambda data, level: zlib.compress(data, level),
+    LZMA: lambda data, level: lzma.compress(data, preset=level),
+}
+
+_decompressors = {
+    NONE: bytes,
+    ZLIB: zlib.decompress,
+    LZMA: lzma.decompress,
+}
+
+_lap_number = struct.Struct("<i")
+_lap_number_offset = TelemetryData.lap_number.offset
+
+
+class ArchiveWriter(object):
+    """Writes an archive as the messages come, one chunk at a time.
+
+    Messages are buffered per tag and source until chunk_rows of them, or
+    until everything buffered is over max_buffered bytes, then the largest
+    buffer is written out. codec is NONE, ZLIB or LZMA.
+    """
+    def __init__(self, filename, chunk_rows=4096, max_buffered=8 << 20, codec=ZLIB, level=6):
+        if codec not in _compressors:
+            raise ValueError("unknown codec: {}".format(codec))
+        self.filename = filename
+        self.chunk_rows = chunk_rows
+        self.max_buffered = max_buffered
+        self.codec = codec
+        self.level = level
+        self.file = open(filename, 'wb')
+        self.file.write(file_header.pack(MAGIC, VERSION, 0, time.time()))
+        self.offset = file_header.size
+        self.sources = []
+        self._source_ids = {}
+        self.chunks = []
+        self.pending = {}
+        self.buffered = 0
+        self._lap = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def source_id(self, source):
+        try:
+            return self._source_ids[source]
+        except KeyError:
+            self._source_ids[source] = len(self.sources)
+            self.sources.append(source)
+            return self._source_ids[source]
+
+    def write(self, tag, payload, timestamp=None, source=""):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        source = self.source_id(source)
+        if tag == b"TLMT" and len(payload) >= _lap_number_offset + 4:
+            self._lap[source] = _lap_number.unpack_from(payload, _lap_number_offset)[0]
+        key = (source, tag)
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = _Pending()
+        pending.times.append(timestamp)
+        pending.laps.append(self._lap.get(source, 0))
+        pending.payloads.append(bytes(payload))
+        pending.nbytes += len(payload)
+        self.buffered += len(payload)
+        if len(pending.payloads) >= self.chunk_rows:
+            self._write_chunk(key)
+        while self.buffered > self.max_buffered:
+            self._write_chunk(max(self.pending, key=lambda k: self.pending[k].nbytes))
+
+    def flush(self):
+        """Write out everything buffered, as short chunks"""
+        for key in list(self.pending):
+            self._write_chunk(key)
+        self.file.flush()
+
+    def _write_chunk(self, key):
+        source, tag = key
+        pending = self.pending.pop(key)
+        self.buffered -= pending.nbytes
+        times = _column(pending.times, 'f8')
+        laps = _column(pending.laps, 'i4')
+        if tag in column_tags:
+            body, rows, laps = _encode_fixed(column_tags[tag], pending.payloads, times, laps)
+        elif tag == b"VHCL":
+            body, rows, laps = _encode_vehicles(pending.payloads, times, laps)
+        else:
+            body, rows, laps = _encode_payloads(pending.payloads, times, laps)
+        body = _compressors[self.codec](body, self.level)
+        header = (tag, source, self.codec, rows, int(laps.min()), int(laps.max()),
+                  float(times.min()), float(times.max()), len(body))
+        self.chunks.append(Chunk(self.offset, *header))
+        self.file.write(chunk_header.pack(*header))
+        self.file.write(body)
+        self.offset += chunk_header.size + len(body)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        index_offset = self.offset
+        out = [struct.pack("<H", len(self.sources))]
+        for source in self.sources:
+            name = source.encode('utf-8')
+            out.append(struct.pack("<B", len(name)) + name)
+        out.append(struct.pack("<I", len(self.chunks)))
+        out.extend(chunk_entry.pack(*chunk) for chunk in self.chunks)
+        out.append(footer.pack(index_offset, INDEX_MAGIC))
+        self.file.write(b"".join(out))
+        self.file.close()
+        self.file = None
+
+
+class _Pending(object):
+    __slots__ = ('times', 'laps', 'payloads', 'nbytes')
+
+    def __init__(self):
+        self.times = array('d')
+        self.laps = array('i')
+        self.payloads = []
+        self.nbytes = 0
+
+
+class ArchiveReader(object):
+    """Memory maps an archive, chunks are only decompressed when read.
+
+    `chunks` holds the Chunk (offset and header) of every chunk in file
+    order, chunks_for() picks the ones of a tag that can hold a lap or a time
+    range and read() decodes them into NumPy arrays.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, self.start_time = file_header.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not an archive".format(filename))
+        if version != VERSION:
+            raise ValueError("unsupported archive version {}".format(version))
+        self.sources = []
+        self.chunks = []
+        if not self._load_index():
+            logging.info("%s has no index, rebuilding it", filename)
+            self._rebuild_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def _load_index(self):
+        if len(self.map) < file_header.size + footer.size:
+            return False
+        index_offset, magic = footer.unpack_from(self.map, len(self.map) - footer.size)
+        if magic != INDEX_MAGIC or index_offset > len(self.map) - footer.size:
+            return False
+        msg = BinaryDecoder(self.map)
+        msg.offset = index_offset
+        for i in range(msg.read_many("H")[0]):
+            self.sources.append(msg.read_string().decode('utf-8'))
+        for i in range(msg.read_many("I")[0]):
+            self.chunks.append(Chunk(*msg.read_many(chunk_entry)))
+        return True
+
+    def _rebuild_index(self):
+        offset = file_header.size
+        sources = set()
+        while offset + chunk_header.size <= len(self.map):
+            chunk = Chunk(offset, *chunk_header.unpack_from(self.map, offset))
+            if offset + chunk_header.size + chunk.size > len(self.map):
+                # truncated last chunk
+                break
+            if (not chunk.tag.isalnum() or chunk.codec not in _decompressors or
+                    chunk.lap_min > chunk.lap_max or chunk.time_min > chunk.time_max):
+                # what is left of the index
+                break
+            self.chunks.append(chunk)
+            sources.add(chunk.source)
+            offset += chunk_header.size + chunk.size
+        # names are only stored in the index
+        self.sources = [str(i) for i in range(max(sources) + 1 if sources else 0)]
+
+    def tags(self):
+        return sorted(set(chunk.tag for chunk in self.chunks))
+
+    def chunks_for(self, tag, source=0, lap=None, start_time=None, end_time=None):
+        """Chunks of a tag whose index says they can hold rows of `lap`
+        and of start_time <= time <= end_time"""
+        selected = []
+        for chunk in self.chunks:
+            if chunk.tag != tag or chunk.source != source:
+                continue
+            if lap is not None and not chunk.lap_min <= lap <= chunk.lap_max:
+                continue
+            if start_time is not None and chunk.time_max < start_time:
+                continue
+            if end_time is not None and chunk.time_min > end_time:
+                continue
+            selected.append(chunk)
+        return selected
+
+    def decode(self, chunk):
+        """The rows of one chunk: Frames for TLMT and SCOR, Vehicles for
+        VHCL and Payloads for the rest, all with the time and lap of every
+        row. Vehicles has them for every message too, frame indexes
+        frame_times, frame_laps and counts."""
+        start = chunk.offset + chunk_header.size
+        body = _decompressors[chunk.codec](self.map[start:start + chunk.size])
+        if chunk.tag in column_tags:
+            return _decode_fixed(column_tags[chunk.tag], body, chunk.rows)
+        elif chunk.tag == b"VHCL":
+            return _decode_vehicles(body, chunk.rows)
+        return _decode_payloads(body, chunk.rows)
+
+    def read(self, tag, source=0, lap=None, start_time=None, end_time=None):
+        """Rows of a tag, only of `lap` and start_time <= time <= end_time
+        if given, decoding only the chunks that can hold them"""
+        import numpy as np
+        parts = []
+        for chunk in self.chunks_for(tag, source, lap, start_time, end_time):
+            part = self.decode(chunk)
+            if isinstance(part, Vehicles):
+                # whole messages, the ones without vehicles too
+                times, laps = part.frame_times, part.frame_laps
+            else:
+                times, laps = part.times, part.laps
+            keep = np.ones(len(times), dtype=bool)
+            if lap is not None:
+                keep &= laps == lap
+            if start_time is not None:
+                keep &= times >= start_time
+            if end_time is not None:
+                keep &= times <= end_time
+            parts.append(_select(part, keep))
+        return _concatenate(tag, parts)
+
+
+def _column(values, dtype):
+    import numpy as np
+    return np.frombuffer(values, dtype=dtype)
+
+
+def _leaves(dtype, base=0):
+    """(offset, dtype) of every scalar in a structured dtype"""
+    for name in dtype.names:
+        field, offset = dtype.fields[name][:2]
+        offset += base
+        shape = ()
+        if field.subdtype is not None:
+            field, shape = field.subdtype
+        count = 1
+        for n in shape:
+            count *= n
+        for i in range(count):
+            if field.names:
+                for leaf in _leaves(field, offset + i * field.itemsize):
+                    yield leaf
+            else:
+                yield offset + i * field.itemsize, field
+
+
+_plans = {}
+
+
+def _plan(layout):
+    """Groups of columns encoded alike: (width, mode, byte offsets), for a
+    structured dtype or one of the specs above"""
+    if layout not in _plans:
+        import numpy as np
+        dtype = np.dtype(list(layout)) if isinstance(layout, tuple) else layout
+        groups = {}
+        covered = np.zeros(dtype.itemsize, dtype=bool)
+        for offset, field in _leaves(dtype):
+            if field.kind == 'f':
+                key = (field.itemsize, 'xor')
+            elif field.kind in 'iu' and field.itemsize > 1:
+                key = (field.itemsize, 'delta')
+            else:
+                key = (1, 'raw')
+                offsets = range(offset, offset + field.itemsize)
+                groups.setdefault(key, []).extend(offsets)
+                covered[offset:offset + field.itemsize] = True
+                continue
+            groups.setdefault(key, []).append(offset)
+            covered[offset:offset + field.itemsize] = True
+        # bytes outside any field, if the layout has holes
+        groups.setdefault((1, 'raw'), []).extend(np.flatnonzero(~covered))
+        _plans[layout] = [(width, mode, np.array(offsets, dtype=np.intp))
+                         for (width, mode), offsets in sorted(groups.items()) if offsets]
+    return _plans[layout]
+
+
+def _encode_columns(raw, dtype):
+    """Encode the rows of `raw`, (n, itemsize) bytes laid out as `dtype`"""
+    import numpy as np
+    n = len(raw)
+    out = []
+    for width, mode, offsets in _plan(dtype):
+        columns = np.ascontiguousarray(raw[:, offsets[:, None] + np.arange(width)])
+        values = columns.view('<u%d' % width).reshape(n, len(offsets))
+        # columns is a copy, numpy buffers the overlapping operands
+        if mode == 'xor':
+            values[1:] ^= values[:-1]
+        elif mode == 'delta':
+            values[1:] -= values[:-1]
+        # one byte plane after the other, column after column
+        planes = values.view(np.uint8).reshape(n, len(offsets), width).transpose(1, 2, 0)
+        out.append(np.ascontiguousarray(planes).tobytes())
+    return b"".join(out)
+
+
+def _decode_columns(body, offset, n, dtype):
+    """Inverse of _encode_columns, returns the (n, itemsize) bytes and
+    the offset past them in body"""
+    import numpy as np
+    plan = _plan(dtype)
+    raw = np.empty((n, sum(width * len(offsets) for width, mode, offsets in plan)),
+                   dtype=np.uint8)
+    for width, mode, offsets in plan:
+        size = n * len(offsets) * width
+        planes = np.frombuffer(body, dtype=np.uint8, count=size, offset=offset)
+        offset += size
+        planes = planes.reshape(len(offsets), width, n).transpose(2, 0, 1)
+        values = np.ascontiguousarray(planes).view('<u%d' % width).reshape(n, len(offsets))
+        if mode == 'xor':
+            values = np.bitwise_xor.accumulate(values, axis=0)
+        elif mode == 'delta':
+            values = np.cumsum(values, axis=0, dtype=values.dtype)
+        raw[:, offsets[:, None] + np.arange(width)] = \
+            values.view(np.uint8).reshape(n, len(offsets), width)
+    return raw, offset
+
+
+# layouts of the columns that are not RFstructs, as NumPy dtype specs
+_times = (('time', '<f8'),)
+_laps = (('lap', '<i4'),)
+_sizes = (('size', '<u4'),)
+_counts = (('count', '<u4'),)
+_vehicle_extra = (('is_player', 'u1'), ('player_control', 'u1'), ('driver', '<i4'))
+
+
+def _encode_common(times, laps):
+    import numpy as np
+    return (_encode_columns(times.view(np.uint8).reshape(-1, 8), _times) +
+            _encode_columns(laps.view(np.uint8).reshape(-1, 4), _laps))
+
+
+def _decode_common(body, n):
+    times, offset = _decode_columns(body, 0, n, _times)
+    laps, offset = _decode_columns(body, offset, n, _laps)
+    return times.view('<f8').reshape(n), laps.view('<i4').reshape(n), offset
+
+
+def _encode_fixed(structure, payloads, times, laps):
+    import numpy as np
+    raw = np.frombuffer(b"".join(payloads), dtype=np.uint8).reshape(len(payloads), -1)
+    if raw.shape[1] != sizeof(structure):
+        raise ValueError("{} payloads of {} bytes".format(structure.__name__, raw.shape[1]))
+    body = _encode_common(times, laps) + _encode_columns(raw, structure.dtype())
+    return body, len(payloads), laps
+
+
+def _decode_fixed(structure, body, n):
+    times, laps, offset = _decode_common(body, n)
+    raw, offset = _decode_columns(body, offset, n, structure.dtype())
+    return Frames(times, laps, raw.view(structure.dtype()).reshape(n))
+
+
+def _encode_vehicles(payloads, times, laps):
+    import numpy as np
+    from .RFstructs import VehicleGrid
+    names = {}
+    size = VehicleData.dtype().itemsize
+    counts = np.empty(len(payloads), dtype='<u4')
+    blocks, is_player, control, drivers = [], [], [], []
+    for frame, payload in enumerate(payloads):
+        grid = VehicleGrid(payload)
+        counts[frame] = len(grid)
+        blocks.append(grid.data.view(np.uint8).reshape(len(grid), size))
+        is_player.append(grid.is_player)
+        control.append(grid.player_control)
+        strings = zip(grid.names("driver_name"), grid.names("vehicle_name"),
+                      grid.names("vehicle_class"))
+        drivers.append(np.array([names.setdefault(s, len(names)) for s in strings],
+                                dtype=np.int32))
+    n = int(counts.sum())
+    extra = np.empty(n, dtype=list(_vehicle_extra))
+    extra['is_player'] = np.concatenate(is_player)
+    extra['player_control'] = np.concatenate(control)
+    extra['driver'] = np.concatenate(drivers)
+    table = [struct.pack("<H", len(names))]
+    for strings in names:
+        table.extend(struct.pack("B", len(s)) + s for s in strings)
+    body = b"".join([
+        b"".join(table),
+        _encode_common(times, laps),
+        _encode_columns(counts.view(np.uint8).reshape(-1, 4), _counts),
+        _encode_columns(extra.view(np.uint8).reshape(n, extra.dtype.itemsize), _vehicle_extra),
+        _encode_columns(np.concatenate(blocks), VehicleData.dtype()),
+    ])
+    return body, len(payloads), laps
+
+
+def _decode_vehicles(body, frames):
+    import numpy as np
+    names = []
+    offset = 2
+    for i in range(struct.unpack_from("<H", body)[0]):
+        strings = []
+        for j in range(3):
+            size = body[offset]
+            strings.append(bytes(body[offset + 1:offset + 1 + size]))
+            offset += 1 + size
+        names.append(tuple(strings))
+    body = body[offset:]
+    frame_times, frame_laps, offset = _decode_common(body, frames)
+    counts, offset = _decode_columns(body, offset, frames, _counts)
+    counts = counts.view('<u4').reshape(frames)
+    n = int(counts.sum())
+    extra, offset = _decode_columns(body, offset, n, _vehicle_extra)
+    extra = extra.view(list(_vehicle_extra)).reshape(n)
+    raw, offset = _decode_columns(body, offset, n, VehicleData.dtype())
+    frame = np.repeat(np.arange(frames, dtype=np.int32), counts)
+    return Vehicles(frame_times[frame], frame_laps[frame], raw.view(VehicleData.dtype()).reshape(n),
+                    frame, extra['is_player'], extra['player_control'], extra['driver'], names,
+                    frame_times, frame_laps, counts)
+
+
+def _encode_payloads(payloads, times, laps):
+    import numpy as np
+    sizes = np.array([len(payload) for payload in payloads], dtype='<u4')
+    body = (_encode_common(times, laps) +
+            _encode_columns(sizes.view(np.uint8).reshape(-1, 4), _sizes) + b"".join(payloads))
+    return body, len(payloads), laps
+
+
+def _decode_payloads(body, n):
+    times, laps, offset = _decode_common(body, n)
+    sizes, offset = _decode_columns(body, offset, n, _sizes)
+    payloads = []
+    for size in sizes.view('<u4').reshape(n):
+        payloads.append(bytes(body[offset:offset + size]))
+        offset += int(size)
+    return Payloads(times, laps, payloads)
+
+
+def _select(part, keep):
+    if isinstance(part, Payloads):
+        return Payloads(part.times[keep], part.laps[keep],
+                        [payload for payload, k in zip(part.payloads, keep) if k])
+    if isinstance(part, Vehicles):
+        # keep is per message, frame is renumbered for the messages kept
+        import numpy as np
+        rows = keep[part.frame]
+        numbers = np.cumsum(keep, dtype=np.int32) - 1
+        return Vehicles(part.times[rows], part.laps[rows], part.data[rows],
+                        numbers[part.frame[rows]], part.is_player[rows],
+                        part.player_control[rows], part.driver[rows], part.names,
+                        part.frame_times[keep], part.frame_laps[keep], part.counts[keep])
+    return Frames(part.times[keep], part.laps[keep], part.data[keep])
+
+
+def _concatenate(tag, parts):
+    """Join the rows of several chunks, VHCL frames and driver numbers are
+    renumbered for the whole"""
+    import numpy as np
+    if tag in column_tags:
+        if not parts:
+            return Frames(np.empty(0, '<f8'), np.empty(0, '<i4'),
+                          np.empty(0, column_tags[tag].dtype()))
+        return Frames(*[np.concatenate(columns) for columns in zip(*parts)])
+    elif tag == b"VHCL":
+        names = {}
+        frames, drivers = [], []
+        first = 0
+        for part in parts:
+            numbers = np.array([names.setdefault(n, len(names)) for n in part.names] or [0])
+            drivers.append(numbers[part.driver])
+            frames.append(part.frame + first)
+            first += len(part.frame_times)
+        if not parts:
+            return Vehicles(np.empty(0, '<f8'), np.empty(0, '<i4'), np.empty(0, VehicleData.dtype()),
+                            np.empty(0, '<i4'), np.empty(0, 'u1'), np.empty(0, 'u1'),
+                            np.empty(0, '<i4'), [], np.empty(0, '<f8'), np.empty(0, '<i4'),
+                            np.empty(0, '<u4'))
+        return Vehicles(np.concatenate([part.times for part in parts]),
+                        np.concatenate([part.laps for part in parts]),
+                        np.concatenate([part.data for part in parts]),
+                        np.concatenate(frames),
+                        np.concatenate([part.is_player for part in parts]),
+                        np.concatenate([part.player_control for part in parts]),
+                        np.concatenate(drivers), list(names),
+                        np.concatenate([part.frame_times for part in parts]),
+                        np.concatenate([part.frame_laps for part in parts]),
+                        np.concatenate([part.counts for part in parts]))
+    if not parts:
+        return Payloads(np.empty(0, '<f8'), np.empty(0, '<i4'), [])
+    return Payloads(np.concatenate([part.times for part in parts]),
+                    np.concatenate([part.laps for part in parts]),
+                    [payload for part in parts for payload in part.payloads])
+
+
+def convert_recording(filename, archive_filename, **kwargs):
+    """Write a recording, or a legacy dump, as an archive. kwargs go to
+    ArchiveWriter."""
+    from .recording import open_recording
+    records = open_recording(filename)
+    names = getattr(records, 'sources', None)
+    with ArchiveWriter(archive_filename, **kwargs) as writer:
+        for tag, timestamp, source, payload in records:
+            writer.write(tag, payload, timestamp, names[source] if names else str(source))
+    close = getattr(records, 'close', None)
+    if close is not None:
+        close()
@@ -0,0 +1,221 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+asyncio counterpart of NetworkClient, many of them can share one event loop
+"""
+
+import asyncio
+import collections
+import logging
+
+from .network_client import (ReceiveBuffer, ConnectionClosed, LATEST, QUEUE,
+                             BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class _PluginProtocol(asyncio.BufferedProtocol):
+    def __init__(self, client):
+        self.client = client
+        self.rbuf = ReceiveBuffer()
+        self.transport = None
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client.protocol = self
+        # send keep-alive to signal we are ready for data
+        transport.write(b"\n")
+
+    def get_buffer(self, sizehint):
+        return self.rbuf.writable()
+
+    def buffer_updated(self, nbytes):
+        self.rbuf.commit(nbytes)
+        try:
+            for tag, payload in self.rbuf.frames():
+                self.client._deliver(tag, payload)
+        except ConnectionClosed:
+            self.transport.close()
+            return
+        # the plugin sends one batch per keep-alive
+        self.transport.write(b"\n")
+
+    def eof_received(self):
+        logging.error("connection shut down")
+        return False
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+
+class AsyncNetworkClient:
+    """Receives the plugin stream on the running event loop.
+
+    Delivery modes and overflow policies are the ones of NetworkClient,
+    except that BLOCK pauses reading from the socket until the consumer
+    releases the data. Either iterate with `async for tag, payload in client`
+    or use wait_data and release_data like with NetworkClient.
+    """
+    def __init__(self, host, port=5556, mode=LATEST, queue_size=1024, overflow=DROP_OLDEST):
+        if mode not in (LATEST, QUEUE):
+            raise ValueError("unknown delivery mode: {}".format(mode))
+        if overflow not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unknown overflow policy: {}".format(overflow))
+        self.host = host
+        self.port = port
+        self.mode = mode
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.new_data = {}
+        self.dropped = collections.Counter()
+        self.high_water = collections.Counter()
+        self.reconnect_delay = 1
+        self.protocol = None
+        self._data_ready = asyncio.Event()
+        self._pending = collections.deque()
+        self._paused = False
+        # None keeps every tag, see subscribe
+        self.tags = None
+        self._subscriptions = []
+        self._shutdown = False
+
+    def shutdown(self):
+        self._shutdown = True
+        self._data_ready.set()
+        if self.protocol:
+            self.protocol.transport.close()
+
+    def is_shutdown(self):
+        return self._shutdown
+
+    def wakeup(self):
+        """Make a pending wait_data return"""
+        self._data_ready.set()
+
+    def subscribe(self, tags):
+        """Same as NetworkClient.subscribe"""
+        self._subscriptions.append(None if tags is None else frozenset(tags))
+        if None in self._subscriptions:
+            self.tags = None
+        else:
+            self.tags = frozenset().union(*self._subscriptions)
+
+    async def startup(self):
+        loop = asyncio.get_running_loop()
+        while not self._shutdown:
+            try:
+                transport, protocol = await loop.create_connection(
+                    lambda: _PluginProtocol(self), self.host, self.port)
+                logging.info("connection successful: %s:%s", self.host, self.port)
+                return protocol
+            except OSError as err:
+                logging.info("couldn't connect, trying reconnect: %s:%s %s", self.host, self.port, err)
+            # wait a moment before trying to reconnect
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def run(self):
+        while not self._shutdown:
+            protocol = await self.startup()
+            if protocol is None:
+                break
+            if self._shutdown:
+                protocol.transport.close()
+            await protocol.closed
+            self.protocol = None
+            self._paused = False
+
+    async def wait_data(self, timeout=None):
+        """Wait until there is data to release or the wait is interrupted.
+
+        Returns True if there is data, False on timeout, shutdown or wakeup.
+        """
+        if not self.new_data and not self._shutdown:
+            try:
+                await asyncio.wait_for(self._data_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._data_ready.clear()
+        return bool(self.new_data)
+
+    def release_data(self):
+        """Same as NetworkClient.release_data"""
+        result = self.new_data
+        self.new_data = {}
+        if self._paused:
+            self._paused = False
+            if self.protocol:
+                self.protocol.transport.resume_reading()
+        return result
+
+    def release_messages(self, with_times=False):
+        """Same as NetworkClient.release_messages, receive times are not
+        measured, they are None"""
+        data = self.release_data()
+        if self.mode == LATEST:
+            messages = list(data.items())
+        else:
+            messages = [(tag, payload) for tag, queue in data.items() for payload in queue]
+        if with_times:
+            return [(tag, payload, None) for tag, payload in messages]
+        return messages
+
+    def queue_stats(self):
+        tags = set(self.new_data) | set(self.dropped) | set(self.high_water)
+        return dict((tag, (len(self.new_data.get(tag, ())),
+                           self.dropped[tag],
+                           self.high_water[tag]))
+                    for tag in tags)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._pending:
+            if self._shutdown:
+                raise StopAsyncIteration
+            if await self.wait_data():
+                self._pending.extend(self.release_messages())
+        return self._pending.popleft()
+
+    def _deliver(self, tag, payload):
+        if self.tags is not None and tag not in self.tags:
+            return
+        if self.mode == LATEST:
+            self.new_data[tag] = payload
+        else:
+            self._enqueue(tag, payload)
+        self._data_ready.set()
+
+    def _enqueue(self, tag, payload):
+        queue = self.new_data.get(tag)
+        if queue is None:
+            queue = self.new_data[tag] = collections.deque()
+        if len(queue) >= self.queue_size:
+            if self.overflow == DROP_NEWEST:
+                self.dropped[tag] += 1
+                return
+            elif self.overflow == DROP_OLDEST:
+                queue.popleft()
+                self.dropped[tag] += 1
+            elif not self._paused:
+                # keep what is already received, stop reading more
+                self._paused = True
+                self.protocol.transport.pause_reading()
+        queue.append(payload)
+        if len(queue) > self.high_water[tag]:
+            self.high_water[tag] = len(queue)
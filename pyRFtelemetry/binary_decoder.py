@@ -21,55 +21,94 @@
 import struct
 
 
+_structs = {}
+
+def compiled(fmt):
+    """Return the cached struct.Struct of a format, formats default to
+    little endian without padding, which is what the plugin sends"""
+    try:
+        return _structs[fmt]
+    except KeyError:
+        st = _structs[fmt] = struct.Struct(fmt if fmt[0] in "@=<>!" else "<" + fmt)
+        return st
+
+
+_char = compiled("B")
+_short = compiled("h")
+_int = compiled("i")
+_float = compiled("f")
+_vect = compiled("fff")
+
+
 class BinaryDecoder:
 
     def __init__(self, data):
         self.data = data
+        self.view = memoryview(data)
         self.offset = 0
 
     def size(self):
         return len(self.data)
 
+    def remaining(self):
+        return len(self.data) - self.offset
+
+    def read_string_view(self):
+        """Pascal string as a memoryview of the data, nothing is copied"""
+        offset = self.offset
+        end = offset + 1 + self.view[offset]
+        self.offset = end
+        return self.view[offset + 1:end]
+
     def read_string(self):
-        len = struct.unpack_from("B", self.data, self.offset)[0]
-        self.offset += 1
-        v = struct.unpack_from("%ds" % len, self.data, self.offset)[0]
-        self.offset += len
-        return v
+        return self.read_string_view().tobytes()
 
     def read_char(self):
-        v = struct.unpack_from("B", self.data, self.offset)[0]
+        v = self.view[self.offset]
         self.offset += 1
         return v
 
     def read_multi_char(self, n):
-        v = struct.unpack_from("B" * n, self.data, self.offset)
+        v = compiled("%dB" % n).unpack_from(self.data, self.offset)
         self.offset += n
         return v
 
     def read_short(self):
-        v = struct.unpack_from("h", self.data, self.offset)[0]
+        v = _short.unpack_from(self.data, self.offset)[0]
         self.offset += 2
         return v
 
     def read_int(self):
-        v = struct.unpack_from("i", self.data, self.offset)[0]
+        v = _int.unpack_from(self.data, self.offset)[0]
         self.offset += 4
         return v
 
     def read_float(self):
-        v = struct.unpack_from("f", self.data, self.offset)[0]
+        v = _float.unpack_from(self.data, self.offset)[0]
         self.offset += 4
         return v
 
     def read_vect(self):
-        v = struct.unpack_from("fff", self.data, self.offset)
+        v = _vect.unpack_from(self.data, self.offset)
         self.offset += 4 * 3
         return v
 
     def read_fmt(self, fmt):
-        v = struct.unpack_from(fmt, self.offset)
-        self.offset += struct.calcsize(fmt)
+        st = compiled(fmt)
+        v = st.unpack_from(self.data, self.offset)
+        self.offset += st.size
+        return v
+
+    def read_many(self, schema):
+        """Read several fields at once.
+
+        `schema` is a struct format or a struct.Struct, the values are
+        returned as a tuple, see compiled() for the default byte order.
+        """
+        if not isinstance(schema, struct.Struct):
+            schema = compiled(schema)
+        v = schema.unpack_from(self.data, self.offset)
+        self.offset += schema.size
         return v
 
 
@@ -0,0 +1,249 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Values derived from the decoded stream, updated frame by frame
+"""
+
+import collections
+import threading
+import time
+
+
+class Channel(object):
+    """A derived value. update is called with every decoded structure of
+    one of `tags`, for VHCL with the player's VehicleData, and returns
+    the new value. `values` holds the other channels, the ones named in
+    `depends` are already updated for this frame. A channel with a bind
+    method gets the engine when added, engine.timestamp is then the
+    receive time of the structure being updated."""
+    name = None
+    tags = (b"TLMT",)
+    depends = ()
+
+    def update(self, st, values):
+        raise NotImplementedError
+
+
+class RevFraction(Channel):
+    name = 'rev_fraction'
+
+    def update(self, tlmt, values):
+        if tlmt.max_engine_rpm <= 0:
+            return 0.0
+        return tlmt.engine_rpm / tlmt.max_engine_rpm
+
+
+class FuelPerLap(Channel):
+    """Mean fuel used over the last `laps` laps, laps with a refuel left
+    out, None until a lap is completed"""
+    name = 'fuel_per_lap'
+
+    def __init__(self, laps=3):
+        self.used = collections.deque(maxlen=laps)
+        self.total = 0.0
+        self.lap = None
+        self.start_fuel = None
+        self.value = None
+
+    def update(self, tlmt, values):
+        if tlmt.lap_number != self.lap:
+            if self.lap is not None and tlmt.lap_number == self.lap + 1:
+                used = self.start_fuel - tlmt.fuel
+                if used > 0:
+                    if len(self.used) == self.used.maxlen:
+                        self.total -= self.used[0]
+                    self.used.append(used)
+                    self.total += used
+                    self.value = self.total / len(self.used)
+            self.lap = tlmt.lap_number
+            self.start_fuel = tlmt.fuel
+        return self.value
+
+
+class LapsOfFuel(Channel):
+    name = 'laps_of_fuel'
+    depends = ('fuel_per_lap',)
+
+    def update(self, tlmt, values):
+        per_lap = values.get('fuel_per_lap')
+        if not per_lap:
+            return None
+        return tlmt.fuel / per_lap
+
+
+class RollingAverage(Channel):
+    """Mean of a field, or of another channel, over the last `window`
+    updates"""
+    def __init__(self, source, window=90, tags=(b"TLMT",), name=None):
+        self.source = source
+        self.window = collections.deque(maxlen=window)
+        self.total = 0.0
+        self.tags = tags
+        self.name = name or '{}_avg{}'.format(source, window)
+
+    def bind(self, engine):
+        if self.source in engine.channels or self.source in channel_types:
+            self.depends = (self.source,)
+
+    def update(self, st, values):
+        if self.depends:
+            value = values.get(self.source)
+            if value is None:
+                return values.get(self.name)
+        else:
+            value = getattr(st, self.source)
+        if len(self.window) == self.window.maxlen:
+            self.total -= self.window[0]
+        self.window.append(value)
+        self.total += value
+        return self.total / len(self.window)
+
+
+class LapDelta(Channel):
+    """Last lap time of the player against its best lap before it,
+    None until there is one to compare"""
+    name = 'lap_delta'
+    tags = (b"VHCL",)
+
+    def __init__(self):
+        self.lap = None
+        self.best = None
+        self.value = None
+
+    def update(self, vehicle, values):
+        if vehicle.total_laps != self.lap:
+            self.lap = vehicle.total_laps
+            last = vehicle.last_lap_time
+            if last > 0:
+                if self.best is not None:
+                    self.value = last - self.best
+                if self.best is None or last < self.best:
+                    self.best = last
+        return self.value
+
+
+class SectorDeltas(Channel):
+    """(sector1, sector2, sector3) times of the player's last lap against
+    the ones of its best lap before it. The game reports sector 2 and the
+    lap time cumulative, they are split here."""
+    name = 'sector_deltas'
+    tags = (b"VHCL",)
+
+    def __init__(self):
+        self.lap = None
+        self.best = None
+        self.best_time = None
+        self.value = None
+
+    def update(self, vehicle, values):
+        if vehicle.total_laps != self.lap:
+            self.lap = vehicle.total_laps
+            s1, s2, lap = vehicle.last_sector1, vehicle.last_sector2, vehicle.last_lap_time
+            if s1 > 0 and s2 > s1 and lap > s2:
+                sectors = (s1, s2 - s1, lap - s2)
+                if self.best is not None:
+                    self.value = tuple(s - b for s, b in zip(sectors, self.best))
+                if self.best_time is None or lap < self.best_time:
+                    self.best = sectors
+                    self.best_time = lap
+        return self.value
+
+
+channel_types = dict((channel.name, channel) for channel in
+                     [RevFraction, FuelPerLap, LapsOfFuel, LapDelta, SectorDeltas])
+
+
+class ChannelEngine(object):
+    """Updates a set of channels in dependency order.
+
+    Consumers require the channels they need by name, or add their own
+    Channel instances, and read them from `values` or with engine[name].
+
+    An engine can only be shared by the consumers of one DecodeHub, each
+    passing the hub's sequence number of the message to update. A message
+    is then counted once, whatever the pace of every consumer, and one
+    older than the last counted of its tag is skipped. Without a sequence
+    number only the same structure as the last one of its tag is skipped,
+    so an engine fed from several clients counts every message again.
+    """
+    def __init__(self):
+        self.channels = {}
+        self.values = {}
+        self.by_tag = {}
+        self.lock = threading.RLock()
+        # receive time of the structure being updated
+        self.timestamp = None
+        self._last = {}
+        self._last_seq = {}
+
+    def __getitem__(self, name):
+        return self.values.get(name)
+
+    def require(self, *names):
+        with self.lock:
+            for name in names:
+                if name not in self.channels:
+                    self.add(channel_types[name]())
+        return self
+
+    def add(self, channel):
+        """Add a channel, the ones it depends on are required first"""
+        with self.lock:
+            if channel.name in self.channels:
+                return self.channels[channel.name]
+            bind = getattr(channel, 'bind', None)
+            if bind is not None:
+                bind(self)
+            self.require(*channel.depends)
+            self.channels[channel.name] = channel
+            for tag in channel.tags:
+                # dependencies were added before, the order holds
+                self.by_tag.setdefault(tag, []).append(channel)
+            return channel
+
+    def update(self, tag, st, seq=None, timestamp=None):
+        """Update the channels of `tag` with a decoded structure, `seq` is
+        its DecodeHub sequence number when the engine is shared and
+        `timestamp` its receive time, now if not given"""
+        channels = self.by_tag.get(tag)
+        if not channels or st is None:
+            return
+        with self.lock:
+            if seq is not None:
+                last = self._last_seq.get(tag)
+                if last is not None and seq <= last:
+                    return
+                self._last_seq[tag] = seq
+            elif self._last.get(tag) is st:
+                return
+            self._last[tag] = st
+            self.timestamp = time.monotonic() if timestamp is None else timestamp
+            if tag == b"VHCL":
+                st = player_vehicle(st)
+                if st is None:
+                    return
+            values = self.values
+            for channel in channels:
+                values[channel.name] = channel.update(st, values)
+
+
+def player_vehicle(vehicles):
+    for vehicle in vehicles:
+        if vehicle.is_player:
+            return vehicle
+    return None
@@ -18,90 +18,141 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from .RFstructs import StructFactory, TelemetryData, InfoData, ScoreData, VehicleData
-from ctypes import Structure, c_int16, c_int8, c_uint8, c_uint16, c_byte, sizeof, memmove
-import ctypes
+from .RFstructs import (StructFactory, LazyFactory, TelemetryData, InfoData, ScoreData,
+                        VehicleData, VehicleGrid, LifecycleEvent, compile_decoder,
+                        fixed_size_tags)
+from .channels import ChannelEngine
+from .delta import LiveDelta
+from .radar import Radar
+from .archive import ArchiveWriter
+from .recording import RecordingWriter
+from .session_store import SessionStore
+from .serial_link import (FrameScheduler, UpstreamReader, Datagram, DownstreamDatagram,
+                          UpstreamDatagram, header1, header2)
+from .stats import AGE, DECODE, DISPATCH
+from ctypes import sizeof
+import inspect
+import logging
 import math
 import time
 
-class Datagram(Structure):
-    def checksum(self):
-        buf = (c_byte*(sizeof(self)-1))()
-        memmove(buf, ctypes.byref(self), sizeof(self)-1)
-        self.check = buf[0]
-        for b2 in buf[1:]:
-            self.check ^= b2
-        
-    def serialize(self):
-        self.checksum()
-        return ctypes.string_at(ctypes.byref(self), ctypes.sizeof(self))
-        
-    def is_valid(self):
-        buf = (c_byte*(sizeof(self)-1))()
-        memmove(buf, ctypes.byref(self), sizeof(self)-1)
-        check = buf[0]
-        for b2 in buf[1:]:
-            check ^= b2
-        
-        return True if self.check == check else False 
-
-header1 = 0xaa #1010 1010
-header2 = 0x50 #0101 0000 
-
-class DownstreamDatagram(Datagram):
-    #Matches simple arduino struct
-    _fields_ = [
-        ("header1", c_byte),
-        ("header2", c_byte),
-        ("screen", c_byte*8),
-        ("dots", c_byte), 
-        ("ledrevs", c_byte),
-        ("fuel", c_byte), 
-        ("grip", c_byte),
-        ("check", c_byte),
-    ]
-    _pack_=1
-    
-    def screen_from_string(self, string):
-        assert len(string) == 8
-        for i, c in enumerate(string.encode('ascii')):
-            self.screen[i] = c
-        
-    def string_from_screen(self):
-        return bytes(self.screen[:]).decode('ascii')
-
-class UpstreamDatagram(Datagram):
-    #Matches simple arduino upstream struct
-    _fields_ = [
-        ("header1", c_byte),
-        ("header2", c_byte),
-        ("buttons1", c_byte),
-        ("buttons2", c_byte), 
-        ("analog1", c_byte),
-        ("analog2", c_byte), 
-        ("check", c_byte),
-    ]
-    _pack_=1 
-    
-    def from_bytes(self, buf):
-        memmove(ctypes.byref(self), buf, sizeof(self))        
-            
-
 class DataConsumer(object):
-    def __init__(self, client):
+    """Base of the consumers, dispatch_message is called for every message.
+
+    A subclass can declare the `tags` it needs, the client then drops the
+    others on arrival, and `fields`, {tag: field names} for TLMT and SCOR,
+    which assemble then decodes alone into a record. Consumers sharing a
+    client go through a DecodeHub (hub.py), assemble then decodes every
+    message once for all of them.
+
+    When the client has stats (see stats.py) the age of every message and
+    the time spent in dispatch_message and assemble are measured, keyed by
+    `name`.
+    """
+    factory = LazyFactory
+    tags = None
+    fields = None
+
+    def __init__(self, client, wait_timeout=1.0):
         self.client=client
+        self.wait_timeout = wait_timeout
+        self.name = type(self).__name__
+        # receive time of the message being dispatched, None if unknown
+        self.receive_time = None
+        self._stop = False
+        self._decoders = dict((tag, compile_decoder(fixed_size_tags[tag], names))
+                              for tag, names in (self.fields or {}).items())
+        # a HubClient shares what is decoded
+        self._shared_assemble = getattr(client, 'assemble', None)
+        self._sequence = getattr(client, 'sequence', None)
+        subscribe = getattr(client, 'subscribe', None)
+        if subscribe is not None:
+            subscribe(self.tags)
 
     def dispatch_message(self, tag, payload):
         raise NotImplementedError          
 
+    def idle(self):
+        """Called by main when no data came in wait_timeout"""
+        pass
+
+    def assemble(self, tag, payload):
+        """Decode a payload with the factory, timed if there are stats.
+        The (rig, tag) tags of a MultiClient are decoded by their tag."""
+        if isinstance(tag, tuple):
+            tag = tag[1]
+        stats = getattr(self.client, 'telemetry_stats', None)
+        if stats is None:
+            return self._assemble(tag, payload)
+        start = time.monotonic()
+        st = self._assemble(tag, payload)
+        stats.add(DECODE, tag, time.monotonic() - start, self.name)
+        return st
+
+    def _assemble(self, tag, payload):
+        decoder = self._decoders.get(tag)
+        if decoder is not None:
+            return decoder(payload)
+        if self._shared_assemble is not None:
+            return self._shared_assemble(tag, payload, self.factory)
+        return self.factory.assemble(tag, payload)
+
+    def sequence(self, payload):
+        """The DecodeHub sequence number of a payload being dispatched, None
+        without a hub"""
+        if self._sequence is None:
+            return None
+        return self._sequence(payload)
+
+    def stop(self):
+        """Make main return, can be called from any thread"""
+        self._stop = True
+        self.client.wakeup()
+
     def main(self):
-        while True:
-            data= self.client.release_data()
-            for tag, payload in data.items():
+        # sleep on the client until data arrives instead of polling it
+        while not self._stop and not self.client.is_shutdown():
+            if not self.client.wait_data(self.wait_timeout):
+                self.idle()
+                continue
+            messages = self.client.release_messages(with_times=True)
+            stats = getattr(self.client, 'telemetry_stats', None)
+            if stats is not None:
+                self._dispatch_timed(messages, stats)
+                continue
+            for tag, payload, received in messages:
+                self.receive_time = received
                 self.dispatch_message(tag, payload)
 
+    def _dispatch_timed(self, messages, stats):
+        add = stats.add
+        name = self.name
+        for tag, payload, received in messages:
+            self.receive_time = received
+            start = time.monotonic()
+            if received is not None:
+                add(AGE, tag, start - received, name)
+            self.dispatch_message(tag, payload)
+            add(DISPATCH, tag, time.monotonic() - start, name)
+
+
+class AsyncDataConsumer(DataConsumer):
+    """DataConsumer for AsyncNetworkClient, dispatch_message may be a coroutine"""
+
+    async def main(self):
+        while not self._stop and not self.client.is_shutdown():
+            if not await self.client.wait_data(self.wait_timeout):
+                self.idle()
+                continue
+            for tag, payload in self.client.release_messages():
+                result = self.dispatch_message(tag, payload)
+                if inspect.isawaitable(result):
+                    await result
+
 
 class ArduinoSimpleRelay(DataConsumer):
+    tags = (b"TLMT", b"VHCL")
+
     @staticmethod
     def char_gear(gear):
         if gear == 0:
@@ -111,9 +162,25 @@ class ArduinoSimpleRelay(DataConsumer):
         else:
             return gear
             
-    def __init__(self, client, ard_serial):
+    def __init__(self, client, ard_serial, channels=None):
         DataConsumer.__init__(self, client)
         self.ard_serial=ard_serial
+        # derived values, the engine may be shared with other consumers of
+        # the same DecodeHub
+        self.channels = ChannelEngine() if channels is None else channels
+        self.channels.require('rev_fraction')
+        self.channels.add(LiveDelta())
+        self.radar = Radar()
+        # the latest VHCL and its receive time, decoded for the radar on scan
+        self.vehicles = None
+        # the 9600 baud link carries ~60 frames/s, only the newest is sent
+        self.link = FrameScheduler(ard_serial)
+        # while a frame is pending, wake up when the link is free again
+        self.idle_timeout = self.wait_timeout
+        self.pending_timeout = self.link.frame_time(sizeof(DownstreamDatagram))
+        # buttons are read in a thread, dispatch only drains its queue
+        self.reader = UpstreamReader(ard_serial)
+        self.reader.start()
         self.rev_leds_thresholds = [0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 0.97, 0.985, 2]
         
         self.this_lap = -1
@@ -150,7 +217,6 @@ class ArduinoSimpleRelay(DataConsumer):
                             int((vhl.last_lap_time%1)*100)
                             )
             dots = 0b0010100
-            print(screen)
             return screen, dots            
 
         def delta_lap_screen(vhl):
@@ -158,21 +224,50 @@ class ArduinoSimpleRelay(DataConsumer):
                 return "d  NA   " , 0b00 
             sign = '+' if vhl.last_lap_time >= self.previous_best else '-'
             delta = abs(self.previous_best - vhl.last_lap_time)
-            print('prev',self.previous_best,'pb',self.personal_best,'last', vhl.last_lap_time,'delta', delta)
+            logging.debug("prev %s pb %s last %s delta %s", self.previous_best,
+                          self.personal_best, vhl.last_lap_time, delta)
             screen = "d {}{:2d}{:03d}".format(sign, 
                             int(delta), 
                             int((delta%1)*100)
                             )
-            print(screen)
             dots = 0b0000100
-            print(screen)
             return screen, dots               
 
+        def live_delta_screen(tlmt):
+            delta = self.channels['live_delta']
+            if delta is None:
+                return "r  NA   ", 0b00
+            sign = '+' if delta >= 0 else '-'
+            delta = min(abs(delta), 99.999)
+            screen = "r {}{:2d}{:03d}".format(sign, int(delta), int((delta%1)*1000))
+            dots = 0b0000100
+            return screen, dots
+
+        def radar_screen(tlmt):
+            # L/R for a car alongside, gap in m and closing km/h of the car
+            # in line behind, or else of the nearest one
+            if self.vehicles is not None:
+                payload, received = self.vehicles
+                self.vehicles = None
+                # an empty grid is kept too, it clears the cars
+                self.radar.update_vehicles(VehicleGrid(payload), received)
+            frame = self.radar.scan()
+            if frame is None or not len(frame.distance):
+                return "   NA   ", 0b00
+            car = frame.behind if frame.behind is not None else frame.nearest[0]
+            screen = "{}{:3d}{:+3d}{}".format('L' if frame.left else ' ',
+                                              min(int(frame.distance[car]), 999),
+                                              max(-99, min(99, int(frame.closing[car]*3.6))),
+                                              'R' if frame.right else ' ')
+            return screen, 0b0
+
         self.modes = {
             1:'speed',
             2:'gear',
             4:'laptime',
             8:'delta_lap',
+            16:'live_delta',
+            32:'radar',
         }
         
         self.mode_type = {
@@ -180,6 +275,8 @@ class ArduinoSimpleRelay(DataConsumer):
             'gear': TelemetryData,
             'laptime': VehicleData,
             'delta_lap': VehicleData,
+            'live_delta': TelemetryData,
+            'radar': TelemetryData,
         }
         
         self.screens = {
@@ -187,23 +284,37 @@ class ArduinoSimpleRelay(DataConsumer):
             'gear': gear_screen,
             'laptime': laptime_screen,
             'delta_lap': delta_lap_screen,
+            'live_delta': live_delta_screen,
+            'radar': radar_screen,
         }
                         
 
     def read_upstream(self):
-        try:
-            if self.ard_serial.inWaiting() >= sizeof(self.upstream):
-                self.upstream.from_bytes(self.ard_serial.read(sizeof(self.upstream)))
-                if self.upstream.is_valid():
-                    try:
-                        self.mode = self.modes[self.upstream.buttons1]
-                    except KeyError:
-                        pass
-        except:
-            raise
+        events = self.reader.events
+        while not events.empty():
+            self.upstream = events.get_nowait()
+            try:
+                self.mode = self.modes[self.upstream.buttons1]
+            except KeyError:
+                pass
+
+    def stop(self):
+        DataConsumer.stop(self)
+        self.reader.stop()
+
+    def idle(self):
+        # the last frame submitted may still be pending
+        self.link.poll()
+        self._schedule()
+
+    def _schedule(self):
+        if self.link.pending is not None:
+            self.wait_timeout = self.pending_timeout
+        else:
+            self.wait_timeout = self.idle_timeout
         
     def another_lap(self, vhl):
-        print('another lap', vhl.total_laps)
+        logging.debug("another lap %s", vhl.total_laps)
         self.manual_mode = self.mode
         self.mode = 'delta_lap'
         self.auto_mode_start = time.time()
@@ -216,21 +327,29 @@ class ArduinoSimpleRelay(DataConsumer):
                 self.previous_best = self.personal_best
         
     def dispatch_message(self, tag, payload):        
+        if isinstance(tag, tuple):
+            # (rig, tag) from a MultiClient
+            tag = tag[1]
         self.read_upstream()
         curr_time = time.time()
         try:
-            st=StructFactory.assemble(tag,payload)
+            st=self.assemble(tag,payload)
             
+            self.channels.update(tag, st, self.sequence(payload), self.receive_time)
+            if tag == b"VHCL":
+                received = self.receive_time if self.receive_time is not None else time.monotonic()
+                self.vehicles = (payload, received)
             if isinstance(st, TelemetryData):
-                self.update_fuel_per_lap(st)
-                rev_fraction = st.engine_rpm/st.max_engine_rpm
+                self.radar.update_player(st)
+                rev_fraction = self.channels['rev_fraction']
                 for ledstate, rt in enumerate(self.rev_leds_thresholds):
                     if rt > rev_fraction:
                         break
                 self.downstream.ledrevs = ledstate
                 self.downstream.fuel = int(st.fuel) 
                            
-            if isinstance(st, list):
+            # a VHCL can come without any vehicle
+            if isinstance(st, list) and st:
                 if isinstance(st[0], VehicleData):
                     for v in st:
                         if v.is_player:
@@ -242,7 +361,8 @@ class ArduinoSimpleRelay(DataConsumer):
                 screen, self.downstream.dots = self.screens[self.mode](st)
                 self.downstream.screen_from_string(screen)
             
-            self.ard_serial.write(self.downstream.serialize())
+            self.link.submit(self.downstream.serialize())
+            self._schedule()
 
             if self.auto_mode_start:
                 if curr_time - self.auto_mode_start > self.auto_mode_duration:
@@ -260,20 +380,62 @@ class DebugPrinter(DataConsumer):
         self.seen = 0
     
     def dispatch_message(self, tag, payload):
-        st = StructFactory.assemble(tag, payload)  
-        print(tag)
+        st = self.assemble(tag, payload)
+        logging.info("%s", st if isinstance(st, LifecycleEvent) else tag)
         self.last[tag] = (payload, st)
         self.seen +=1
         if self.seen >= self.stop_after:
             raise Exception("Raised after {} messages were dispatched".format(self.stop_after))
             
 class FileDump(DataConsumer):
+    """Records everything received, see recording.py for the format.
+
+    Call close() when done, it writes the index of the recording.
+    """
     def __init__(self, client, filename):
         DataConsumer.__init__(self, client)
         self.filename = filename        
+        self.writer = RecordingWriter(filename)
+        self.source = "{}:{}".format(getattr(client, 'host', ''), getattr(client, 'port', ''))
         
     def dispatch_message(self, tag, payload):
-        with open(self.filename, 'ba+') as f:
-            f.write(tag)
-            f.write(payload)
-    
\ No newline at end of file
+        if isinstance(tag, tuple):
+            # (rig, tag) from a MultiClient
+            source, tag = tag
+        else:
+            source = self.source
+        timestamp = self.receive_time if self.receive_time is not None else time.monotonic()
+        self.writer.write(tag, payload, timestamp, source)
+
+    def close(self):
+        self.writer.close()
+
+
+class ArchiveDump(FileDump):
+    """Same as FileDump, but writes a compressed archive, see archive.py.
+    kwargs go to ArchiveWriter."""
+    def __init__(self, client, filename, **kwargs):
+        DataConsumer.__init__(self, client)
+        self.filename = filename
+        self.writer = ArchiveWriter(filename, **kwargs)
+        self.source = "{}:{}".format(getattr(client, 'host', ''), getattr(client, 'port', ''))
+
+
+class SessionRecorder(DataConsumer):
+    """Feeds a SessionStore (see session_store.py), which can be queried
+    from other threads meanwhile. It is cleared when a session starts."""
+    tags = (b"TLMT", b"SCOR", b"VHCL", b"STSS")
+
+    def __init__(self, client, store=None):
+        DataConsumer.__init__(self, client)
+        self.store = SessionStore() if store is None else store
+
+    def dispatch_message(self, tag, payload):
+        if isinstance(tag, tuple):
+            # (rig, tag) from a MultiClient
+            tag = tag[1]
+        if tag == b"STSS":
+            self.store.clear()
+        else:
+            # the receive time, as FileDump records it
+            self.store.add(tag, payload, self.receive_time)
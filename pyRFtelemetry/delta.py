@@ -0,0 +1,122 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Running delta of the current lap against the best one, at telemetry rate
+"""
+
+from array import array
+from bisect import bisect_left
+import math
+import time
+
+from .channels import Channel
+
+
+class ReferenceLap(object):
+    """Elapsed time against distance driven of a whole lap. `distances`
+    only grows, so a distance is found by bisection. Never modified once
+    built, it is replaced as a whole."""
+    def __init__(self, lap, lap_time, distances, times):
+        self.lap = lap
+        self.lap_time = lap_time
+        self.distances = distances
+        self.times = times
+        self.length = distances[-1]
+
+    def time_at(self, distance):
+        """Elapsed time at a distance, linearly interpolated"""
+        distances = self.distances
+        i = bisect_left(distances, distance)
+        if i == 0:
+            return self.times[0]
+        if i == len(distances):
+            return self.times[-1]
+        d0 = distances[i - 1]
+        t0 = self.times[i - 1]
+        span = distances[i] - d0
+        if span <= 0:
+            return t0
+        return t0 + (self.times[i] - t0) * (distance - d0) / span
+
+
+class LiveDelta(Channel):
+    """Seconds the current lap is behind (positive) or ahead of the best
+    lap at the same distance, None until there is a best lap.
+
+    The lap time is the receive time (ChannelEngine.timestamp) since the
+    first frame of the lap, so frames dropped in the LATEST mode or by a
+    shared engine do not shorten it. The distance is the path length of
+    TelemetryData.position over the lap, a dropped frame only cuts a
+    corner there. Only laps seen from their start can become the reference,
+    the swap is a single assignment so readers in other threads always see
+    a whole reference.
+    """
+    name = 'live_delta'
+
+    def __init__(self, reference=None):
+        self.reference = reference
+        self.lap = None
+        self.lap_start_ET = None
+        self.engine = None
+        self.start = None
+        self.elapsed = 0.0
+        self.distance = 0.0
+        self.last_position = None
+        self.distances = None
+        self.times = None
+
+    def bind(self, engine):
+        self.engine = engine
+
+    def update(self, tlmt, values):
+        position = tlmt.position
+        x, y, z = position[0], position[1], position[2]
+        now = self.engine.timestamp if self.engine is not None else None
+        if now is None:
+            now = time.monotonic()
+        if tlmt.lap_number != self.lap:
+            self._new_lap(tlmt)
+            self.start = now
+        else:
+            self.elapsed = now - self.start
+            last = self.last_position
+            self.distance += math.sqrt((x - last[0]) ** 2 + (y - last[1]) ** 2 + (z - last[2]) ** 2)
+        self.last_position = (x, y, z)
+        if self.distances is not None:
+            self.distances.append(self.distance)
+            self.times.append(self.elapsed)
+        reference = self.reference
+        if reference is None:
+            return None
+        return self.elapsed - reference.time_at(self.distance)
+
+    def _new_lap(self, tlmt):
+        previous = self.lap
+        if (previous is not None and tlmt.lap_number == previous + 1 and
+                self.distances is not None and len(self.distances) > 1):
+            # the lap time is what the game says, not the sum of the frames
+            lap_time = tlmt.lap_start_ET - self.lap_start_ET
+            if self.reference is None or lap_time < self.reference.lap_time:
+                self.reference = ReferenceLap(previous, lap_time, self.distances, self.times)
+        # a lap joined halfway or after a reset can't be a reference
+        self.distances = array('d') if previous is not None else None
+        self.times = array('d') if previous is not None else None
+        self.lap = tlmt.lap_number
+        self.lap_start_ET = tlmt.lap_start_ET
+        self.elapsed = 0.0
+        self.distance = 0.0
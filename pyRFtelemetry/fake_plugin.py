@@ -0,0 +1,293 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Python stand-in for the rfactorlcd plugin (src/rfactorlcd.cpp), to run
+clients without the game, for instance to load test them
+"""
+
+from .RFstructs import TelemetryData, ScoreData, InfoData, VehicleData
+from .recording import open_recording
+import logging
+import math
+import selectors
+import socket
+import struct
+import threading
+import time
+
+header = struct.Struct("<4sI")
+
+# what a client asked for, as in the plugin
+kTelemetryData = 1 << 0
+kScoreData = 1 << 1
+kAllData = kTelemetryData | kScoreData
+
+# TLMT payloads can carry their send time in the dent bytes
+stamp = struct.Struct("<d")
+stamp_offset = TelemetryData.dent.offset
+
+
+def message(tag, payload=b""):
+    """Frame a payload the way the plugin does"""
+    return header.pack(tag, len(payload) + header.size) + bytes(payload)
+
+
+def pascal(string):
+    if isinstance(string, str):
+        string = string.encode('ascii')
+    return struct.pack("<B", len(string)) + string
+
+
+def info_payload(track_name="Test Track", player_name="Player", prl_file="player.PLR",
+                 end_ET=1800.0, max_laps=20, lap_distance=4000.0):
+    info = InfoData(end_ET=end_ET, max_laps=max_laps, lap_distance=lap_distance)
+    return pascal(track_name) + pascal(player_name) + pascal(prl_file) + bytes(info)
+
+
+def vehicles_payload(vehicles):
+    """`vehicles` holds (VehicleData, is_player, player_control,
+    driver_name, vehicle_name, vehicle_class) tuples"""
+    out = [struct.pack("<i", len(vehicles))]
+    for vehicle, is_player, control, driver, name, vclass in vehicles:
+        out.append(struct.pack("<BB", is_player, control))
+        out.append(pascal(driver) + pascal(name) + pascal(vclass))
+        out.append(bytes(vehicle))
+    return b"".join(out)
+
+
+def orient(st, angle, speed):
+    """Orientation and local velocity of a car going anticlockwise (seen
+    from above, x to z) around the circle at `angle`. Local axes as in the
+    game: x left, y up, z to the rear. The rows of the orientation matrix
+    turn them into world axes."""
+    rear = (math.sin(angle), 0.0, -math.cos(angle))
+    left = (-math.cos(angle), 0.0, -math.sin(angle))
+    up = (0.0, 1.0, 0.0)
+    for row, orig in enumerate([st.origx, st.origy, st.origz]):
+        orig[0], orig[1], orig[2] = left[row], up[row], rear[row]
+    st.velocity[0] = st.velocity[1] = 0.0
+    st.velocity[2] = -speed
+
+
+class SyntheticSource(object):
+    """Made up traffic for a car lapping a circular track.
+
+    Yields (time, tag, payload), time in seconds from the start. TLMT comes
+    at `rate` Hz and INFO, SCOR and VHCL for `grid_size` cars at score_rate
+    Hz, between STSS and EDSS. Every burst_every seconds burst_size extra
+    VHCL are sent back to back.
+    """
+    def __init__(self, rate=90, score_rate=2, grid_size=20, duration=None,
+                 burst_every=None, burst_size=0, lap_time=60.0, track_length=4000.0):
+        self.rate = rate
+        self.score_rate = score_rate
+        self.grid_size = grid_size
+        self.duration = duration
+        self.burst_every = burst_every
+        self.burst_size = burst_size
+        self.lap_time = lap_time
+        self.track_length = track_length
+
+    def telemetry(self, t):
+        tlmt = TelemetryData()
+        tlmt.delta_time = 1.0 / self.rate
+        tlmt.lap_number = int(t // self.lap_time)
+        tlmt.lap_start_ET = tlmt.lap_number * self.lap_time
+        angle = 2 * math.pi * (t % self.lap_time) / self.lap_time
+        radius = self.track_length / (2 * math.pi)
+        tlmt.position[0] = radius * math.cos(angle)
+        tlmt.position[2] = radius * math.sin(angle)
+        orient(tlmt, angle, self.track_length / self.lap_time)
+        tlmt.gear = 4
+        tlmt.max_engine_rpm = 9000
+        tlmt.engine_rpm = 6000 + 2500 * math.sin(angle * 8)
+        tlmt.fuel = max(0.0, 100.0 - t / self.lap_time * 2.5)
+        return bytes(tlmt)
+
+    def vehicles(self, t):
+        vehicles = []
+        radius = self.track_length / (2 * math.pi)
+        for i in range(self.grid_size):
+            lap_time = self.lap_time * (1 + 0.01 * i)
+            vehicle = VehicleData()
+            vehicle.total_laps = int(t // lap_time)
+            vehicle.place = i + 1
+            vehicle.lap_distance = self.track_length * (t % lap_time) / lap_time
+            vehicle.lap_start_ET = vehicle.total_laps * lap_time
+            vehicle.last_lap_time = lap_time if vehicle.total_laps else 0
+            vehicle.best_lap_time = vehicle.last_lap_time
+            angle = 2 * math.pi * vehicle.lap_distance / self.track_length
+            vehicle.position[0] = radius * math.cos(angle)
+            vehicle.position[2] = radius * math.sin(angle)
+            orient(vehicle, angle, self.track_length / lap_time)
+            vehicles.append((vehicle, i == 0, 0, "Driver %d" % i, "Car %d" % i, "GT"))
+        return vehicles_payload(vehicles)
+
+    def __iter__(self):
+        yield 0.0, b"STSS", b""
+        yield 0.0, b"INFO", info_payload(lap_distance=self.track_length)
+        tick = 0
+        score_every = max(1, int(round(self.rate / self.score_rate))) if self.score_rate else None
+        burst_every = int(round(self.burst_every * self.rate)) if self.burst_every else None
+        while True:
+            t = tick / float(self.rate)
+            if self.duration is not None and t >= self.duration:
+                break
+            yield t, b"TLMT", self.telemetry(t)
+            if score_every and tick % score_every == 0:
+                score = ScoreData(current_ET=t, in_realtime=b"\x01")
+                yield t, b"SCOR", bytes(score)
+                yield t, b"VHCL", self.vehicles(t)
+            if burst_every and tick and tick % burst_every == 0:
+                vehicles = self.vehicles(t)
+                for i in range(self.burst_size):
+                    yield t, b"VHCL", vehicles
+            tick += 1
+        yield t, b"EDSS", b""
+
+
+def recording_source(filename, speed=1.0):
+    """Traffic from a recording or a legacy dump, `speed` scales its timing"""
+    first = None
+    for tag, timestamp, source, payload in open_recording(filename):
+        if first is None:
+            first = timestamp
+        yield (timestamp - first) / speed, tag, bytes(payload)
+
+
+class FakePluginServer(object):
+    """Serves a source of (time, tag, payload) to any number of clients.
+
+    Like the plugin, a client only gets TLMT after it sent a keep-alive
+    and then not again until the next one, same for the score messages.
+    Messages nobody asked for are counted in `skipped`. With
+    honor_keepalive=False everything is sent to every client. With
+    stamp=True the send time (time.monotonic) of every TLMT is written
+    into its dent bytes for latency measurements.
+    """
+    def __init__(self, source, host="127.0.0.1", port=0, honor_keepalive=True, stamp=False):
+        self.source = source
+        self.honor_keepalive = honor_keepalive
+        self.stamp = stamp
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+        self.host, self.port = self.listener.getsockname()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.clients = {}
+        self.sent = {}
+        self.skipped = {}
+        self.finished = threading.Event()
+        self._shutdown = False
+
+    def shutdown(self):
+        self._shutdown = True
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        # the source starts with the first client, like a session would
+        while not self.clients and not self._shutdown:
+            for key, events in self.selector.select(0.1):
+                if key.data is None:
+                    self._accept()
+        start = time.monotonic()
+        messages = iter(self.source)
+        pending = next(messages, None)
+        try:
+            while not self._shutdown:
+                now = time.monotonic()
+                if pending is None:
+                    self.finished.set()
+                    timeout = 0.1
+                else:
+                    timeout = max(0.0, start + pending[0] - now)
+                for key, events in self.selector.select(timeout):
+                    if key.data is None:
+                        self._accept()
+                    else:
+                        self._receive(key.fileobj)
+                now = time.monotonic()
+                while pending is not None and start + pending[0] <= now:
+                    self.send(pending[1], pending[2])
+                    pending = next(messages, None)
+        finally:
+            for sock in list(self.clients):
+                self._close(sock)
+            self.selector.close()
+            self.listener.close()
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(1)
+        self.clients[sock] = 0
+        self.selector.register(sock, selectors.EVENT_READ, address)
+        logging.info("fake plugin: client connected %s", address)
+
+    def _receive(self, sock):
+        try:
+            data = sock.recv(1024)
+        except socket.error:
+            data = b""
+        if data:
+            self.clients[sock] = kAllData
+        else:
+            self._close(sock)
+
+    def _close(self, sock):
+        self.selector.unregister(sock)
+        del self.clients[sock]
+        sock.close()
+
+    def send(self, tag, payload):
+        if tag == b"TLMT":
+            mask = kTelemetryData
+        elif tag in (b"SCOR", b"INFO", b"VHCL"):
+            mask = kScoreData
+        else:
+            mask = kAllData
+        if tag == b"TLMT" and self.stamp:
+            payload = (payload[:stamp_offset] + stamp.pack(time.monotonic()) +
+                       payload[stamp_offset + stamp.size:])
+        data = message(tag, payload)
+        for sock, wants in list(self.clients.items()):
+            if self.honor_keepalive and not wants & mask:
+                self.skipped[tag] = self.skipped.get(tag, 0) + 1
+                continue
+            try:
+                sock.sendall(data)
+            except socket.error as err:
+                logging.info("fake plugin: send failed %s", err)
+                self._close(sock)
+                continue
+            self.sent[tag] = self.sent.get(tag, 0) + 1
+            if tag == b"TLMT":
+                self.clients[sock] = wants & ~kTelemetryData
+            elif tag == b"VHCL":
+                # VHCL closes the score update
+                self.clients[sock] = wants & ~kScoreData
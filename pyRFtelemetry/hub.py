@@ -0,0 +1,206 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fan-out of one client to many consumers, decoding every message once
+"""
+
+import collections
+import itertools
+import threading
+
+
+class _Entry(object):
+    __slots__ = ('seq', 'tag', 'payload', 'received', 'decoded')
+
+    def __init__(self, seq, tag, payload, received):
+        self.seq = seq
+        self.tag = tag
+        self.payload = payload
+        self.received = received
+        self.decoded = None
+
+
+class DecodeHub(object):
+    """Releases the messages of a client and hands them to any number of
+    consumers, each one at its own pace.
+
+    Messages are kept in a log numbered by sequence, every consumer gets a
+    HubClient (see connect) with its own cursor in it and is built on
+    that instead of the client. What the consumers assemble is decoded once
+    per message and factory and shared. An entry is freed once every cursor
+    is past it, or when the log holds more than max_entries, in which case
+    the consumers that did not see it count it in `dropped`.
+
+    Use the client in QUEUE mode for every consumer to see every message.
+    """
+    def __init__(self, client, max_entries=4096, wait_timeout=1.0):
+        self.client = client
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.data_ready = threading.Condition(self.lock)
+        self.entries = collections.deque()
+        self.next_seq = 0
+        self.cursors = []
+        self.decodes = 0
+        self._shutdown = False
+
+    def connect(self):
+        """Return a new HubClient, it starts at the next message"""
+        with self.lock:
+            cursor = HubClient(self, self.next_seq)
+            self.cursors.append(cursor)
+        return cursor
+
+    def disconnect(self, cursor):
+        with self.lock:
+            self.cursors.remove(cursor)
+            self._trim()
+
+    def shutdown(self):
+        self._shutdown = True
+        with self.lock:
+            self.data_ready.notify_all()
+
+    def is_shutdown(self):
+        return self._shutdown or self.client.is_shutdown()
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        client = self.client
+        while not self.is_shutdown():
+            if not client.wait_data(self.wait_timeout):
+                continue
+            messages = client.release_messages(with_times=True)
+            with self.lock:
+                seq = self.next_seq
+                for tag, payload, received in messages:
+                    self.entries.append(_Entry(seq, tag, payload, received))
+                    seq += 1
+                self.next_seq = seq
+                self._trim()
+                self.data_ready.notify_all()
+        with self.lock:
+            self.data_ready.notify_all()
+
+    def _trim(self):
+        # called with the lock held
+        entries = self.entries
+        if len(entries) > self.max_entries:
+            first = self.next_seq - self.max_entries
+            for cursor in self.cursors:
+                if cursor.position < first:
+                    cursor.dropped += first - cursor.position
+                    cursor.position = first
+        if self.cursors:
+            low = min(cursor.position for cursor in self.cursors)
+        else:
+            low = self.next_seq
+        while entries and entries[0].seq < low:
+            entries.popleft()
+
+    def _release(self, cursor):
+        with self.lock:
+            entries = self.entries
+            start = cursor.position - entries[0].seq if entries else 0
+            released = list(itertools.islice(entries, start, None))
+            cursor.position = self.next_seq
+            self._trim()
+        return released
+
+
+class HubClient(object):
+    """A consumer's view of a DecodeHub, used in place of a NetworkClient"""
+    def __init__(self, hub, position):
+        self.hub = hub
+        self.position = position
+        self.dropped = 0
+        self.tags = None
+        self._released = {}
+        self._woken = False
+
+    def subscribe(self, tags):
+        """Only release these tags to this consumer, None for all of them"""
+        self.tags = None if tags is None else frozenset(tags)
+        subscribe = getattr(self.hub.client, 'subscribe', None)
+        if subscribe is not None:
+            subscribe(tags)
+
+    def is_shutdown(self):
+        return self.hub.is_shutdown()
+
+    def wakeup(self):
+        with self.hub.data_ready:
+            self._woken = True
+            self.hub.data_ready.notify_all()
+
+    def wait_data(self, timeout=None):
+        hub = self.hub
+        with hub.data_ready:
+            hub.data_ready.wait_for(
+                lambda: self.position < hub.next_seq or hub.is_shutdown() or self._woken,
+                timeout)
+            self._woken = False
+            return self.position < hub.next_seq
+
+    def release_messages(self, with_times=False):
+        """List of (tag, payload), with with_times (tag, payload, receive
+        time) as the hub's client measured it"""
+        entries = self.hub._release(self)
+        tags = self.tags
+        if tags is not None:
+            # a MultiClient tags with (rig, tag)
+            entries = [entry for entry in entries
+                       if (entry.tag[1] if isinstance(entry.tag, tuple) else entry.tag) in tags]
+        # assemble finds the entries back by their payload
+        self._released = dict((id(entry.payload), entry) for entry in entries)
+        if with_times:
+            return [(entry.tag, entry.payload, entry.received) for entry in entries]
+        return [(entry.tag, entry.payload) for entry in entries]
+
+    def release_data(self):
+        """The newest payload of every tag, like the LATEST mode"""
+        return dict(self.release_messages())
+
+    def sequence(self, payload):
+        """The hub's sequence number of a payload released last, None for
+        any other payload"""
+        entry = self._released.get(id(payload))
+        if entry is None or entry.payload is not payload:
+            return None
+        return entry.seq
+
+    def assemble(self, tag, payload, factory):
+        """factory.assemble(tag, payload), shared by the consumers"""
+        entry = self._released.get(id(payload))
+        if entry is None or entry.payload is not payload:
+            return factory.assemble(tag, payload)
+        decoded = entry.decoded
+        if decoded is None:
+            decoded = entry.decoded = {}
+        try:
+            return decoded[factory]
+        except KeyError:
+            self.hub.decodes += 1
+            st = decoded[factory] = factory.assemble(tag, payload)
+            return st
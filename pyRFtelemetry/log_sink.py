@@ -0,0 +1,82 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Logging that never writes from the telemetry threads: records go through
+a queue to handlers run by a listener thread, repeated messages are sampled
+"""
+
+import logging
+import logging.handlers
+import queue
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through `burst` records of every message (by its format
+    string) per `interval` seconds. How many were left out is added to the
+    next one let through."""
+    def __init__(self, interval=1.0, burst=5):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = record.created
+        start, count, skipped = self.windows.get(key, (now, 0, 0))
+        if now - start >= self.interval:
+            start, count = now, 0
+        if count >= self.burst:
+            self.windows[key] = (start, count, skipped + 1)
+            return False
+        self.windows[key] = (start, count + 1, 0)
+        if skipped:
+            record.msg = "{} [{} similar skipped]".format(record.msg, skipped)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the queue is full"""
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def queue_logging(*handlers, level=logging.DEBUG, interval=1.0, burst=5, maxsize=10000,
+                  logger=None):
+    """Route `logger`, the root one by default, through a queue to
+    `handlers`, which are then run in a listener thread.
+
+    Returns the listener, stop() it at exit to flush what is queued.
+    """
+    if logger is None:
+        logger = logging.getLogger()
+    handler = DroppingQueueHandler(queue.Queue(maxsize))
+    handler.addFilter(SamplingFilter(interval, burst))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    listener = logging.handlers.QueueListener(handler.queue, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
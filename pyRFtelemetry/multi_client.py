@@ -0,0 +1,307 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Receives from many plugin connections in a single thread and selector
+"""
+
+import errno
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from .network_client import ReceiveBuffer, ConnectionClosed
+
+
+class Rig:
+    """State and counters of one plugin connection"""
+    def __init__(self, name, host, port):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.rbuf = None
+        # resolved in a thread of its own, see MultiClient._resolve
+        self.address = None
+        self.resolving = False
+        self.resolve_error = None
+        self.connected = False
+        self.retry_at = 0
+        self.backoff = 0
+        self.keepalive_sent = 0
+        self.bytes = 0
+        self.frames = 0
+        self.reconnects = 0
+        self.latency = 0.0
+        self.latency_max = 0.0
+
+
+class MultiClient:
+    """Holds any number of plugin connections in one selector.
+
+    Messages are kept like in the LATEST mode of NetworkClient but keyed by
+    (rig name, tag), so release_data returns {(rig, tag): payload} and a
+    DataConsumer receives (rig, tag) as the tag. DataConsumer.assemble
+    decodes those, FileDump records the rig as the source and the relay
+    and SessionRecorder take the tag alone, but they keep a single state:
+    with more than one rig it mixes the rigs, give them a client each.
+    Connections that fail are retried with an exponential backoff between
+    min_backoff and max_backoff. Host names are resolved in a thread, a
+    slow or failing lookup only holds back its own rig.
+    """
+    def __init__(self, min_backoff=1, max_backoff=30):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.selector = selectors.DefaultSelector()
+        self.rigs = {}
+        self.lock = threading.Lock()
+        self.data_ready = threading.Condition(self.lock)
+        self.new_data = {}
+        # receive times shaped like new_data
+        self.receive_times = {}
+        self.released_times = {}
+        self._last_stats = (time.monotonic(), 0, 0)
+        # None keeps every tag, see subscribe
+        self.tags = None
+        self._subscriptions = []
+        self._shutdown = False
+        self._woken = False
+
+    def add_rig(self, host, port=5556, name=None):
+        """Add a connection, must be called before run"""
+        if name is None:
+            name = "{}:{}".format(host, port)
+        if name in self.rigs:
+            raise ValueError("duplicated rig name: {}".format(name))
+        rig = self.rigs[name] = Rig(name, host, port)
+        return rig
+
+    def subscribe(self, tags):
+        """Register the tags (without the rig) a consumer needs, None for all of them.
+
+        Once every consumer subscribed with a set of tags, frames of any
+        other tag are dropped on arrival instead of being stored.
+        """
+        self._subscriptions.append(None if tags is None else frozenset(tags))
+        if None in self._subscriptions:
+            self.tags = None
+        else:
+            self.tags = frozenset().union(*self._subscriptions)
+
+    def shutdown(self):
+        self._shutdown = True
+        with self.lock:
+            self.data_ready.notify_all()
+
+    def is_shutdown(self):
+        return self._shutdown
+
+    def wakeup(self):
+        with self.data_ready:
+            self._woken = True
+            self.data_ready.notify_all()
+
+    def wait_data(self, timeout=None):
+        with self.data_ready:
+            self.data_ready.wait_for(
+                lambda: self.new_data or self._shutdown or self._woken, timeout)
+            self._woken = False
+            return bool(self.new_data)
+
+    def release_data(self):
+        self.lock.acquire()
+        result = self.new_data
+        self.new_data = {}
+        self.released_times = self.receive_times
+        self.receive_times = {}
+        self.lock.release()
+        return result
+
+    def release_messages(self, with_times=False):
+        """List of ((rig, tag), payload), with with_times the receive time
+        is added to every message"""
+        data = self.release_data()
+        if with_times:
+            times = self.released_times
+            return [(tag, payload, times.get(tag)) for tag, payload in data.items()]
+        return list(data.items())
+
+    def stats(self):
+        """Return aggregate figures since the previous call.
+
+        connected: rigs currently connected out of all rigs
+        frames_per_s, bytes_per_s: received by all rigs
+        latency, latency_max: mean and worst time in seconds from a
+        keep-alive to the data it requested, over the connected rigs
+        """
+        now = time.monotonic()
+        rigs = list(self.rigs.values())
+        frames = sum(rig.frames for rig in rigs)
+        nbytes = sum(rig.bytes for rig in rigs)
+        last_time, last_frames, last_bytes = self._last_stats
+        self._last_stats = (now, frames, nbytes)
+        elapsed = max(now - last_time, 1e-9)
+        connected = [rig for rig in rigs if rig.connected]
+        return {
+            'rigs': len(rigs),
+            'connected': len(connected),
+            'frames_per_s': (frames - last_frames) / elapsed,
+            'bytes_per_s': (nbytes - last_bytes) / elapsed,
+            'reconnects': sum(rig.reconnects for rig in rigs),
+            'latency': sum(rig.latency for rig in connected) / len(connected) if connected else 0.0,
+            'latency_max': max([rig.latency_max for rig in connected] or [0.0]),
+        }
+
+    def run(self):
+        while not self._shutdown:
+            now = time.monotonic()
+            timeout = 0.5
+            for rig in self.rigs.values():
+                if rig.sock is None and not rig.resolving:
+                    if rig.resolve_error is not None:
+                        err, rig.resolve_error = rig.resolve_error, None
+                        self._disconnect(rig, err)
+                        timeout = min(timeout, rig.retry_at - now)
+                    elif rig.retry_at > now:
+                        timeout = min(timeout, rig.retry_at - now)
+                    elif rig.address is None:
+                        self._resolve(rig)
+                    else:
+                        self._connect(rig)
+
+            for key, events in self.selector.select(timeout):
+                rig = key.data
+                try:
+                    if rig.connected:
+                        self._receive(rig)
+                    else:
+                        self._connected(rig)
+                except (ConnectionClosed, socket.error) as err:
+                    self._disconnect(rig, err)
+
+        for rig in self.rigs.values():
+            if rig.sock:
+                self.selector.unregister(rig.sock)
+                rig.sock.close()
+                rig.sock = None
+        self.selector.close()
+
+    def _resolve(self, rig):
+        # getaddrinfo blocks, the selector loop must not wait for it
+        def resolve():
+            try:
+                family, kind, proto, name, address = socket.getaddrinfo(
+                    rig.host, rig.port, socket.AF_INET, socket.SOCK_STREAM)[0]
+                rig.address = address
+            except OSError as err:
+                rig.resolve_error = err
+            rig.resolving = False
+        rig.resolving = True
+        thread = threading.Thread(target=resolve)
+        thread.daemon = True
+        thread.start()
+
+    def _connect(self, rig):
+        try:
+            rig.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            rig.sock.setblocking(0)
+            err = rig.sock.connect_ex(rig.address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(err, "connect failed")
+            self.selector.register(rig.sock, selectors.EVENT_WRITE, rig)
+        except OSError as err:
+            self._disconnect(rig, err)
+
+    def _connected(self, rig):
+        err = rig.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, "connect failed")
+        logging.info("connection successful: %s (%s:%s)", rig.name, rig.host, rig.port)
+        rig.connected = True
+        rig.backoff = 0
+        rig.rbuf = ReceiveBuffer()
+        self.selector.modify(rig.sock, selectors.EVENT_READ, rig)
+        self._keepalive(rig)
+
+    def _disconnect(self, rig, err):
+        if rig.connected:
+            logging.error("connection to %s lost: %s", rig.name, err)
+            rig.reconnects += 1
+        else:
+            logging.info("couldn't connect, trying reconnect: %s (%s:%s) %s",
+                         rig.name, rig.host, rig.port, err)
+            # the address is looked up again, it may have changed
+            rig.address = None
+        if rig.sock is not None:
+            try:
+                self.selector.unregister(rig.sock)
+            except (KeyError, ValueError):
+                pass
+            rig.sock.close()
+            rig.sock = None
+        rig.rbuf = None
+        rig.connected = False
+        rig.backoff = min(max(rig.backoff * 2, self.min_backoff), self.max_backoff)
+        rig.retry_at = time.monotonic() + rig.backoff
+
+    def _keepalive(self, rig):
+        # send keep-alive to signal we are ready for data
+        rig.sock.send(b"\n")
+        rig.keepalive_sent = time.monotonic()
+
+    def _receive(self, rig):
+        if rig.keepalive_sent:
+            latency = time.monotonic() - rig.keepalive_sent
+            rig.latency += 0.1 * (latency - rig.latency)
+            rig.latency_max = max(rig.latency_max, latency)
+            rig.keepalive_sent = 0
+
+        rbuf = rig.rbuf
+        while True:
+            try:
+                nbytes = rig.sock.recv_into(rbuf.writable())
+            except socket.error as serr:
+                if serr.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    raise
+                break
+            if nbytes == 0:
+                raise ConnectionClosed("connection shut down")
+            rbuf.commit(nbytes)
+            rig.bytes += nbytes
+
+        name = rig.name
+        tags = self.tags
+        frames = 0
+        stored = 0
+        received = time.monotonic()
+        self.lock.acquire()
+        try:
+            for tag, payload in rbuf.frames():
+                frames += 1
+                if tags is not None and tag not in tags:
+                    continue
+                self.new_data[(name, tag)] = payload
+                self.receive_times[(name, tag)] = received
+                stored += 1
+            if stored:
+                self.data_ready.notify_all()
+        finally:
+            self.lock.release()
+        rig.frames += frames
+        self._keepalive(rig)
@@ -20,6 +20,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import errno
 import select
 import socket
@@ -29,28 +30,108 @@ import time
 import logging
 import sys
 
+from .stats import QUEUE_DELAY
+
 
 class ConnectionClosed(Exception):
     pass
 
 
+# delivery modes
+LATEST = 'latest'
+QUEUE = 'queue'
+
+# overflow policies of the queue mode
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+
 class NetworkClient:
-    def __init__(self, host, port=5556):
+    """Receives the plugin stream in a background thread (see run).
+
+    In LATEST mode only the newest payload of each tag is kept until the
+    consumer releases it. In QUEUE mode every payload is kept in a bounded
+    queue per tag, when a queue is full the overflow policy decides whether
+    the network thread waits (BLOCK) or a payload is dropped (DROP_OLDEST,
+    DROP_NEWEST).
+
+    The receive time of every frame is kept next to it, see
+    release_messages. With a TelemetryStats as `stats` the time it waited
+    for release is measured too, see stats.py.
+    """
+    def __init__(self, host, port=5556, mode=LATEST, queue_size=1024, overflow=DROP_OLDEST,
+                 stats=None):
+        if mode not in (LATEST, QUEUE):
+            raise ValueError("unknown delivery mode: {}".format(mode))
+        if overflow not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unknown overflow policy: {}".format(overflow))
         self.host = host
         self.port = port
         self.sock = None
         self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.data_ready = threading.Condition(self.lock)
         self.new_data = {}
+        self.mode = mode
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.dropped = collections.Counter()
+        self.high_water = collections.Counter()
+        # not `stats`, MultiClient.stats() is a method
+        self.telemetry_stats = stats
+        # receive times shaped like new_data
+        self.receive_times = {}
+        self.released_times = {}
+        # None keeps every tag, see subscribe
+        self.tags = None
+        self._subscriptions = []
         self._shutdown = False
+        self._woken = False
 
 
     def shutdown(self):
         self._shutdown = True
+        with self.lock:
+            self.not_full.notify_all()
+            self.data_ready.notify_all()
         try:
             self.sock.shutdown(socket.SHUT_WR)
         except:
             pass
 
+    def is_shutdown(self):
+        return self._shutdown
+
+    def wakeup(self):
+        """Make a pending wait_data return, can be called from any thread"""
+        with self.data_ready:
+            self._woken = True
+            self.data_ready.notify_all()
+
+    def wait_data(self, timeout=None):
+        """Block until there is data to release or the wait is interrupted.
+
+        Returns True if there is data, False on timeout, shutdown or wakeup.
+        """
+        with self.data_ready:
+            self.data_ready.wait_for(
+                lambda: self.new_data or self._shutdown or self._woken, timeout)
+            self._woken = False
+            return bool(self.new_data)
+
+    def subscribe(self, tags):
+        """Register the tags a consumer needs, None for all of them.
+
+        Once every consumer subscribed with a set of tags, frames of any
+        other tag are dropped on arrival instead of being stored.
+        """
+        self._subscriptions.append(None if tags is None else frozenset(tags))
+        if None in self._subscriptions:
+            self.tags = None
+        else:
+            self.tags = frozenset().union(*self._subscriptions)
+
     def startup(self):
         while not self._shutdown:
             try:
@@ -74,22 +155,110 @@ class NetworkClient:
                 self.startup()
             try:
                 self.update(verbose = verbose)
-            except ConnectionClosed as err:
+            except (ConnectionClosed, socket.error) as err:
+                # a reset or broken pipe is a lost connection too
+                if not self._shutdown:
+                    logging.error("connection lost: %s", err)
+                self.sock.close()
                 self.startup()
         if self.sock:
             self.sock.close()
 
     def release_data(self):
+        """Hand over everything received since the last call.
+
+        Returns a dict tag -> payload in LATEST mode and a dict
+        tag -> deque of payloads, oldest first, in QUEUE mode.
+        """
         self.lock.acquire()
         result = self.new_data
         self.new_data = {}
+        times = self.receive_times
+        self.receive_times = {}
+        self.not_full.notify_all()
         self.lock.release()
+        self.released_times = times
+        if self.telemetry_stats is not None:
+            self._measure_release(times)
         return result
 
+    def release_messages(self, with_times=False):
+        """Hand over everything received as a list of (tag, payload).
+
+        With with_times (tag, payload, receive time) instead, the time is
+        None when it was not measured.
+        """
+        data = self.release_data()
+        if with_times:
+            times = self.released_times
+            if self.mode == LATEST:
+                return [(tag, payload, times.get(tag)) for tag, payload in data.items()]
+            messages = []
+            for tag, queue in data.items():
+                received = times.get(tag) or [None] * len(queue)
+                messages.extend(zip([tag] * len(queue), queue, received))
+            return messages
+        if self.mode == LATEST:
+            return list(data.items())
+        return [(tag, payload) for tag, queue in data.items() for payload in queue]
+
+    def _measure_release(self, times):
+        now = time.monotonic()
+        add = self.telemetry_stats.add
+        if self.mode == LATEST:
+            for tag, received in times.items():
+                add(QUEUE_DELAY, tag, now - received)
+        else:
+            for tag, received in times.items():
+                for t in received:
+                    add(QUEUE_DELAY, tag, now - t)
+
+    def queue_stats(self):
+        """Return tag -> (depth, dropped, high water mark) for the QUEUE mode"""
+        with self.lock:
+            tags = set(self.new_data) | set(self.dropped) | set(self.high_water)
+            return dict((tag, (len(self.new_data.get(tag, ())),
+                               self.dropped[tag],
+                               self.high_water[tag]))
+                        for tag in tags)
+
+    def _enqueue(self, tag, payload, received=None):
+        # called with the lock held
+        queue = self.new_data.get(tag)
+        if queue is None:
+            queue = self.new_data[tag] = collections.deque()
+        if len(queue) >= self.queue_size:
+            if self.overflow == DROP_NEWEST:
+                self.dropped[tag] += 1
+                return
+            elif self.overflow == DROP_OLDEST:
+                queue.popleft()
+                if received is not None:
+                    self.receive_times[tag].popleft()
+                self.dropped[tag] += 1
+            else:
+                # the consumer has to know there is data to make room
+                self.data_ready.notify_all()
+                while not self._shutdown:
+                    self.not_full.wait(0.1)
+                    queue = self.new_data.get(tag)
+                    if queue is None:
+                        queue = self.new_data[tag] = collections.deque()
+                    if len(queue) < self.queue_size:
+                        break
+                else:
+                    return
+        queue.append(payload)
+        if received is not None:
+            times = self.receive_times.get(tag)
+            if times is None:
+                times = self.receive_times[tag] = collections.deque()
+            times.append(received)
+        if len(queue) > self.high_water[tag]:
+            self.high_water[tag] = len(queue)
+
     def update(self, verbose = False):
-        stream = b""
-        buf = bytearray(4096)
-        view = memoryview(buf)
+        rbuf = ReceiveBuffer()
         while not self._shutdown:
             # send keep-alive to signal we are ready for data
             self.sock.sendall("\n".encode('ascii'))
@@ -99,36 +268,109 @@ class NetworkClient:
             # read all data
             while not self._shutdown:
                 try:
-                    nbytes = self.sock.recv_into(view, 4096)
+                    nbytes = self.sock.recv_into(rbuf.writable())
                     if nbytes == 0:
                         logging.error("connection shut down")
                         raise ConnectionClosed()
-                    stream += view[0:nbytes].tobytes()
+                    rbuf.commit(nbytes)
                 except socket.error as serr:
                     if serr.errno != errno.EWOULDBLOCK:
                         raise
                     break
 
+            frames = rbuf.frames()
+            if self.tags is not None:
+                frames = self._subscribed(frames)
+            if verbose:
+                frames = list(frames)
             self.lock.acquire()
-            while len(stream) >= 8:
-                tag, size = struct.unpack_from("4sI", stream)
-                if len(stream) < size:
-                    # need more data from the network
-                    break
-                else:
-                    # fout.write(stream[0:size])
-                    payload = stream[8:size]
-                    stream = stream[size:]
-
-                    # if data comes in faster then it gets eaten,
-                    # discard it, only keep the latest copy of
-                    # each tag
-                    self.new_data[tag] = payload
-            self.lock.release()
+            try:
+                # in LATEST mode only the latest copy of each tag is
+                # kept, if data comes in faster it is discarded
+                self._store_timed(frames, time.monotonic())
+                if self.new_data:
+                    self.data_ready.notify_all()
+            finally:
+                self.lock.release()
             if verbose:
-                print('Updated {}'.format(tag))
+                logging.debug("updated %s", [tag for tag, payload in frames])
 
+    def _subscribed(self, frames):
+        tags = self.tags
+        for frame in frames:
+            if frame[0] in tags:
+                yield frame
 
+    def _store_timed(self, frames, received):
+        # the lock is held
+        if self.mode == QUEUE:
+            for tag, payload in frames:
+                self._enqueue(tag, payload, received)
+        else:
+            for tag, payload in frames:
+                self.new_data[tag] = payload
+                self.receive_times[tag] = received
 
 
+class ReceiveBuffer:
+    """Receive buffer that frames the plugin stream without copying it.
 
+    Data is received straight into a preallocated block and complete
+    frames are handed out as memoryview slices of that block. When the
+    free space at the end runs out a new block is allocated and only the
+    incomplete frame left over is carried across, so views already handed
+    out stay valid and every received byte is copied at most once more.
+    """
+    header = struct.Struct("4sI")
+
+    def __init__(self, block_size=65536, min_free=4096):
+        self.block_size = block_size
+        self.min_free = min_free
+        self.buf = bytearray(block_size)
+        self.view = memoryview(self.buf)
+        self.read_pos = 0
+        self.write_pos = 0
+        # size of the incomplete frame at read_pos, if its header is known
+        self.expected = 0
+
+    def pending(self):
+        return self.write_pos - self.read_pos
+
+    def writable(self):
+        """Return a view of the free space, making room when needed"""
+        if (len(self.buf) - self.write_pos < self.min_free or
+                len(self.buf) - self.read_pos < self.expected):
+            self._renew()
+        return self.view[self.write_pos:]
+
+    def commit(self, nbytes):
+        self.write_pos += nbytes
+
+    def _renew(self):
+        pending = self.write_pos - self.read_pos
+        # grow geometrically so a backlog is not copied over and over
+        size = max(self.block_size, 2 * (pending + self.min_free), self.expected)
+        buf = bytearray(size)
+        buf[0:pending] = self.view[self.read_pos:self.write_pos]
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.read_pos = 0
+        self.write_pos = pending
+
+    def frames(self):
+        """Yield (tag, payload) for every complete frame received so far"""
+        unpack_from = self.header.unpack_from
+        view = self.view
+        while self.write_pos - self.read_pos >= 8:
+            tag, size = unpack_from(view, self.read_pos)
+            if size < 8:
+                logging.error("invalid frame size %s for tag %s", size, tag)
+                raise ConnectionClosed()
+            if self.write_pos - self.read_pos < size:
+                # need more data from the network
+                self.expected = size
+                break
+            start = self.read_pos
+            self.read_pos += size
+            self.expected = 0
+            yield tag, view[start + 8:start + size]
@@ -0,0 +1,126 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Where the other cars are around the player, for the whole grid at once
+"""
+
+from collections import namedtuple
+import time
+
+RadarFrame = namedtuple('RadarFrame', 'drivers local distance closing nearest left right behind')
+
+
+class Radar(object):
+    """Positions of the other cars relative to the player.
+
+    VHCL only comes twice a second, the cars are moved on from there with
+    their velocity up to the time of scan(). The player is taken from the
+    latest TLMT when there is one, which is fresher than its VHCL row.
+    Vectors in VehicleData and TelemetryData are in the car's axes, the
+    rows of the orientation matrix (origx, origy, origz) turn them into
+    world ones.
+    """
+    def __init__(self, car_length=5.0, car_width=2.0, side_range=6.0, behind_range=30.0,
+                 nearest=3):
+        self.car_length = car_length
+        self.car_width = car_width
+        self.side_range = side_range
+        self.behind_range = behind_range
+        self.nearest = nearest
+        self.grid = None
+        self.grid_time = None
+        self.positions = None
+        self.velocities = None
+        self.player = None
+        self.player_time = None
+
+    def update_vehicles(self, grid, timestamp=None):
+        """Take the cars of a VehicleGrid"""
+        import numpy as np
+        data = grid.data
+        self.positions = data['position'].astype(np.float64)
+        self.velocities = np.einsum('nij,nj->ni', _orientations(data), data['velocity'])
+        self.grid = grid
+        self.grid_time = time.monotonic() if timestamp is None else timestamp
+
+    def update_player(self, tlmt, timestamp=None):
+        """Take the player from a TelemetryData, it is only read by scan()"""
+        self.player = tlmt
+        self.player_time = time.monotonic() if timestamp is None else timestamp
+
+    def scan(self, timestamp=None):
+        """RadarFrame at `timestamp`, None until the player is known.
+
+        The arrays have a row per other car: drivers, its row in the grid,
+        local, its position in the player's axes (x left, y up, z to the
+        rear), distance and closing, the m/s at which the gap shrinks.
+        nearest indexes the closest cars, left and right tell if a car is
+        alongside and behind indexes the closest one in line behind.
+        """
+        import numpy as np
+        grid = self.grid
+        if grid is None:
+            return None
+        if timestamp is None:
+            timestamp = time.monotonic()
+        index = grid.player_index
+        positions = self.positions + self.velocities * (timestamp - self.grid_time)
+        tlmt = self.player
+        if tlmt is not None:
+            orientation = np.array([tlmt.origx[:], tlmt.origy[:], tlmt.origz[:]])
+            if not orientation.any():
+                orientation = np.eye(3)
+            velocity = orientation.dot(tlmt.velocity[:])
+            position = np.array(tlmt.position[:]) + velocity * (timestamp - self.player_time)
+        elif index is not None:
+            position = positions[index]
+            velocity = self.velocities[index]
+            orientation = _orientations(grid.data[index:index + 1])[0]
+        else:
+            return None
+        others = np.arange(len(positions))
+        if index is not None:
+            others = np.delete(others, index)
+        offsets = positions[others] - position
+        relative = self.velocities[others] - velocity
+        distance = np.sqrt((offsets ** 2).sum(axis=1))
+        closing = -(offsets * relative).sum(axis=1) / np.maximum(distance, 1e-6)
+        # world to player axes is the transposed orientation
+        local = offsets.dot(orientation)
+        nearest = np.argsort(distance)[:self.nearest]
+        x, z = local[:, 0], local[:, 2]
+        alongside = (np.abs(z) < self.car_length) & (np.abs(x) < self.side_range)
+        left = bool((alongside & (x > 0)).any())
+        right = bool((alongside & (x < 0)).any())
+        in_line = ((z >= self.car_length) & (z < self.behind_range) &
+                   (np.abs(x) < self.car_width))
+        behind = None
+        if in_line.any():
+            candidates = np.flatnonzero(in_line)
+            behind = int(candidates[distance[candidates].argmin()])
+        return RadarFrame(others, local, distance, closing, nearest, left, right, behind)
+
+
+def _orientations(data):
+    """(n, 3, 3) orientation matrices of VehicleData rows, a car without
+    one (all zeros) gets the identity"""
+    import numpy as np
+    orientations = np.stack([data['origx'], data['origy'], data['origz']], axis=1).astype(np.float64)
+    missing = ~orientations.any(axis=(1, 2))
+    orientations[missing] = np.eye(3)
+    return orientations
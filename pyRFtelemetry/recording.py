@@ -0,0 +1,387 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Indexed recordings of the plugin stream
+
+A recording is a file header, the framed records and, once the writer
+is closed, an index followed by a footer pointing at it:
+
+    header  "RFTR", version (H), flags (H), wall clock start time (d)
+    record  tag (4s), payload size (I), monotonic receive time (d),
+            source id (H), payload
+    index   sources: count (H), then a Pascal string per source
+            tags: count (I), then per tag: tag (4s), count (I) and
+                  count (offset (Q), time (d)) pairs
+            laps: count (I), then (source (H), lap (i), offset (Q),
+                  time (d)) for every TLMT starting a new lap
+    footer  index offset (Q), "RFTI"
+
+A recording without footer, for instance after a crash, is still
+readable, the index is rebuilt by walking the records.
+"""
+
+from .RFstructs import TelemetryData, ScoreData, InfoData, VehicleData
+from .binary_decoder import BinaryDecoder
+from array import array
+from ctypes import sizeof
+import bisect
+import logging
+import mmap
+import struct
+import time
+
+MAGIC = b"RFTR"
+INDEX_MAGIC = b"RFTI"
+VERSION = 1
+
+file_header = struct.Struct("<4sHHd")
+record_header = struct.Struct("<4sIdH")
+footer = struct.Struct("<Q4s")
+lap_entry = struct.Struct("<HiQd")
+
+# offset of lap_number in a TLMT payload
+_lap_number = struct.Struct("<i")
+_lap_number_offset = 4
+
+
+class RecordingWriter(object):
+    """Appends framed records to a recording through one buffered file"""
+
+    def __init__(self, filename, buffering=1 << 20):
+        self.filename = filename
+        self.file = open(filename, 'wb', buffering=buffering)
+        self.file.write(file_header.pack(MAGIC, VERSION, 0, time.time()))
+        self.offset = file_header.size
+        self.sources = []
+        self._source_ids = {}
+        self.offsets = {}
+        self.times = {}
+        self.laps = []
+        self._lap = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def source_id(self, source):
+        """Id of a source name (a rig, a host), adding it if needed"""
+        try:
+            return self._source_ids[source]
+        except KeyError:
+            self._source_ids[source] = len(self.sources)
+            self.sources.append(source)
+            return self._source_ids[source]
+
+    def write(self, tag, payload, timestamp=None, source=""):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        source = self.source_id(source)
+        offset = self.offset
+        self.file.write(record_header.pack(tag, len(payload), timestamp, source))
+        self.file.write(payload)
+        self.offset += record_header.size + len(payload)
+
+        if tag not in self.offsets:
+            self.offsets[tag] = array('Q')
+            self.times[tag] = array('d')
+        self.offsets[tag].append(offset)
+        self.times[tag].append(timestamp)
+
+        if tag == b"TLMT" and len(payload) >= _lap_number_offset + 4:
+            lap = _lap_number.unpack_from(payload, _lap_number_offset)[0]
+            if self._lap.get(source) != lap:
+                self._lap[source] = lap
+                self.laps.append((source, lap, offset, timestamp))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        index_offset = self.offset
+        out = [struct.pack("<H", len(self.sources))]
+        for source in self.sources:
+            name = source.encode('utf-8')
+            out.append(struct.pack("<B", len(name)) + name)
+        out.append(struct.pack("<I", len(self.offsets)))
+        for tag, offsets in self.offsets.items():
+            out.append(struct.pack("<4sI", tag, len(offsets)))
+            out.append(offsets.tobytes())
+            out.append(self.times[tag].tobytes())
+        out.append(struct.pack("<I", len(self.laps)))
+        out.extend(lap_entry.pack(*lap) for lap in self.laps)
+        out.append(footer.pack(index_offset, INDEX_MAGIC))
+        self.file.write(b"".join(out))
+        self.file.close()
+        self.file = None
+
+
+class RecordingReader(object):
+    """Memory maps a recording, payloads are returned as views of the map.
+
+    `offsets` and `times` hold, per tag, the file offset and receive time
+    of every record in order, `laps` the TLMT records starting a lap.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version, flags, self.start_time = file_header.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a recording".format(filename))
+        if version > VERSION:
+            raise ValueError("unsupported recording version {}".format(version))
+        self.sources = []
+        self.offsets = {}
+        self.times = {}
+        self.laps = []
+        self.end = len(self.map)
+        if not self._load_index():
+            logging.info("%s has no index, rebuilding it", filename)
+            self._rebuild_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
+            # payload views are still in use, the map goes with the last one
+            pass
+        self.file.close()
+
+    def _load_index(self):
+        if len(self.map) < file_header.size + footer.size:
+            return False
+        index_offset, magic = footer.unpack_from(self.map, len(self.map) - footer.size)
+        if magic != INDEX_MAGIC or index_offset > len(self.map) - footer.size:
+            return False
+        msg = BinaryDecoder(self.map)
+        msg.offset = index_offset
+        for i in range(msg.read_many("H")[0]):
+            self.sources.append(msg.read_string().decode('utf-8'))
+        for i in range(msg.read_many("I")[0]):
+            tag, count = msg.read_many("4sI")
+            self.offsets[tag] = array('Q', self.map[msg.offset:msg.offset + 8 * count])
+            msg.offset += 8 * count
+            self.times[tag] = array('d', self.map[msg.offset:msg.offset + 8 * count])
+            msg.offset += 8 * count
+        for i in range(msg.read_many("I")[0]):
+            self.laps.append(msg.read_many(lap_entry))
+        self.end = index_offset
+        return True
+
+    def _rebuild_index(self):
+        # same bookkeeping as the writer, walking the records
+        offset = file_header.size
+        laps = {}
+        sources = set()
+        while offset + record_header.size <= len(self.map):
+            tag, size, timestamp, source = record_header.unpack_from(self.map, offset)
+            start = offset + record_header.size
+            if start + size > len(self.map):
+                # truncated last record
+                break
+            if tag not in self.offsets:
+                self.offsets[tag] = array('Q')
+                self.times[tag] = array('d')
+            self.offsets[tag].append(offset)
+            self.times[tag].append(timestamp)
+            sources.add(source)
+            if tag == b"TLMT" and size >= _lap_number_offset + 4:
+                lap = _lap_number.unpack_from(self.map, start + _lap_number_offset)[0]
+                if laps.get(source) != lap:
+                    laps[source] = lap
+                    self.laps.append((source, lap, offset, timestamp))
+            offset = start + size
+        self.end = offset
+        # names are only stored in the index
+        self.sources = [str(i) for i in range(max(sources) + 1 if sources else 0)]
+
+    def read(self, offset):
+        """Return (tag, timestamp, source, payload) of the record at offset"""
+        tag, size, timestamp, source = record_header.unpack_from(self.map, offset)
+        start = offset + record_header.size
+        return tag, timestamp, source, self.view[start:start + size]
+
+    def __iter__(self):
+        return self.records()
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self.offsets.values())
+
+    def records(self, start_time=None, end_time=None, tags=None):
+        """Yield (tag, timestamp, source, payload) in file order.
+
+        With `tags` only the records of those tags are read, through the
+        index. start_time and end_time bound the receive time.
+        """
+        if tags is not None:
+            for offset in self._merged_offsets(tags, start_time, end_time):
+                yield self.read(offset)
+            return
+        offset = self.seek_time(start_time) if start_time is not None else file_header.size
+        while offset < self.end:
+            record = self.read(offset)
+            if end_time is not None and record[1] > end_time:
+                break
+            offset += record_header.size + len(record[3])
+            yield record
+
+    def _merged_offsets(self, tags, start_time, end_time):
+        selected = array('Q')
+        for tag in tags:
+            if tag not in self.offsets:
+                continue
+            times = self.times[tag]
+            first = bisect.bisect_left(times, start_time) if start_time is not None else 0
+            last = bisect.bisect_right(times, end_time) if end_time is not None else len(times)
+            selected.extend(self.offsets[tag][first:last])
+        return sorted(selected)
+
+    def seek_time(self, timestamp):
+        """Offset of the first record received at or after timestamp"""
+        offset = self.end
+        for tag, times in self.times.items():
+            i = bisect.bisect_left(times, timestamp)
+            if i < len(times):
+                offset = min(offset, self.offsets[tag][i])
+        return offset
+
+    def lap_times(self, lap, source=0):
+        """Return (start, end) receive times of a lap of a source, end is
+        None for the last lap of the recording"""
+        start = end = None
+        for lap_source, lap_number, offset, timestamp in self.laps:
+            if lap_source != source:
+                continue
+            if start is not None:
+                end = timestamp
+                break
+            if lap_number == lap:
+                start = timestamp
+        if start is None:
+            raise KeyError("lap {} not in recording".format(lap))
+        return start, end
+
+    def lap_records(self, lap, source=0, tags=None):
+        start, end = self.lap_times(lap, source)
+        for record in self.records(start, end, tags):
+            if record[2] == source and (end is None or record[1] < end):
+                yield record
+
+
+def _legacy_size(tag, data, offset):
+    # size of the payload of a legacy record, None if it can't be parsed
+    if tag in (b"STSS", b"EDSS", b"STRT", b"EDRT"):
+        return 0
+    elif tag == b"TLMT":
+        return sizeof(TelemetryData)
+    elif tag == b"SCOR":
+        return sizeof(ScoreData)
+    msg = BinaryDecoder(data)
+    msg.offset = offset
+    if tag == b"INFO":
+        for i in range(3):
+            msg.read_string_view()
+        return msg.offset - offset + sizeof(InfoData)
+    elif tag == b"VHCL":
+        for i in range(msg.read_int()):
+            msg.offset += 2
+            for j in range(3):
+                msg.read_string_view()
+            msg.offset += sizeof(VehicleData)
+        return msg.offset - offset
+    return None
+
+
+legacy_tags = (b"STSS", b"EDSS", b"STRT", b"EDRT", b"TLMT", b"SCOR", b"INFO", b"VHCL")
+
+def load_legacy(filename):
+    """Read a dump of the old FileDump (tag + payload without size) and
+    return its messages as a list of (tag, payload).
+
+    Payload sizes are worked out from the tag. If that fails the next known
+    tag is searched for 4 bytes at a time, as arduino_replay.py used to do.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    recovered = []
+    place = 0
+    while place + 4 <= len(data):
+        tag = data[place:place + 4]
+        if tag not in legacy_tags:
+            place += 4
+            continue
+        try:
+            size = _legacy_size(tag, data, place + 4)
+        except (struct.error, IndexError):
+            size = None
+        end = place + 4 + size if size is not None else None
+        if end is None or end > len(data) or (end < len(data) and data[end:end + 4] not in legacy_tags):
+            end = place + 4
+            while end < len(data) and data[end:end + 4] not in legacy_tags:
+                end += 4
+        recovered.append((tag, data[place + 4:end]))
+        place = end
+    return recovered
+
+
+def legacy_records(legacy_filename, source=0):
+    """Return the messages of a legacy dump as recording records,
+    (tag, timestamp, source, payload).
+
+    The dump has no timestamps, they are made up from the delta_time of
+    the TLMT messages, which advances 1/90 s per message in rFactor.
+    """
+    records = []
+    timestamp = 0.0
+    for tag, payload in load_legacy(legacy_filename):
+        if tag == b"TLMT" and len(payload) >= 4:
+            delta_time = struct.unpack_from("<f", payload)[0]
+            if 0 < delta_time < 1:
+                timestamp += delta_time
+        records.append((tag, timestamp, source, payload))
+    return records
+
+
+def convert_legacy(legacy_filename, filename, source="legacy"):
+    """Write a legacy dump as a recording, see legacy_records"""
+    with RecordingWriter(filename) as writer:
+        for tag, timestamp, source_id, payload in legacy_records(legacy_filename):
+            writer.write(tag, payload, timestamp, source)
+
+
+def open_recording(filename):
+    """Open a recording or a legacy dump, either way the result iterates
+    over (tag, timestamp, source, payload)"""
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return RecordingReader(filename)
+    return legacy_records(filename)
@@ -0,0 +1,161 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replays recordings with their original timing, scaled, or as fast as possible
+"""
+
+from .network_client import NetworkClient, LATEST, DROP_OLDEST
+from .recording import RecordingReader, open_recording
+import logging
+import time
+
+# speed of a replay
+REALTIME = 1.0
+MAX_SPEED = None
+
+
+class Replay(object):
+    """Iterates over a recording yielding (tag, payload).
+
+    `records` is a RecordingReader, a filename or anything yielding
+    (tag, timestamp, source, payload). speed 1.0 follows the receive times
+    of the recording, 10.0 runs ten times faster and MAX_SPEED does not
+    wait at all. With `sources` the tag is (source name, tag), like the
+    MultiClient delivers it. Payloads from recordings are views of the
+    memory map, nothing is copied.
+    """
+    def __init__(self, records, speed=REALTIME, start_time=None, end_time=None,
+                 tags=None, sources=False):
+        if isinstance(records, str):
+            records = open_recording(records)
+        self.records = records
+        self.speed = speed
+        self.start_time = start_time
+        self.end_time = end_time
+        self.tags = tags
+        self.sources = sources
+        self.replayed = 0
+        # worst delay behind the schedule, in seconds
+        self.max_lag = 0.0
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+
+    def _records(self):
+        if isinstance(self.records, RecordingReader):
+            return self.records.records(self.start_time, self.end_time, self.tags)
+        return (record for record in self.records
+                if (self.tags is None or record[0] in self.tags) and
+                   (self.start_time is None or record[1] >= self.start_time) and
+                   (self.end_time is None or record[1] <= self.end_time))
+
+    def _source_name(self, source):
+        names = getattr(self.records, 'sources', None)
+        if names and source < len(names):
+            return names[source]
+        return str(source)
+
+    def __iter__(self):
+        first = None
+        for tag, timestamp, source, payload in self._records():
+            if self._stop:
+                break
+            if self.speed:
+                now = time.monotonic()
+                if first is None:
+                    first = timestamp
+                    start = now
+                due = start + (timestamp - first) / self.speed
+                if due > now:
+                    time.sleep(due - now)
+                else:
+                    self.max_lag = max(self.max_lag, now - due)
+            self.replayed += 1
+            if self.sources:
+                yield (self._source_name(source), tag), payload
+            else:
+                yield tag, payload
+
+    def feed(self, consumer):
+        """Dispatch the whole replay to a consumer in this thread"""
+        dispatch = consumer.dispatch_message
+        for tag, payload in self:
+            dispatch(tag, payload)
+
+
+class ReplayClient(NetworkClient):
+    """Stands in for NetworkClient, delivering a Replay instead of the
+    network. run() in a thread and use release_data/wait_data as usual,
+    usually with mode=QUEUE and overflow=BLOCK so that no message is lost
+    when replaying faster than the consumer keeps up.
+
+    Once the replay is over it waits for the consumer to release what is
+    left, unless nothing is released for drain_timeout seconds.
+    """
+    def __init__(self, replay, mode=LATEST, queue_size=1024, overflow=DROP_OLDEST,
+                 drain_timeout=5.0):
+        NetworkClient.__init__(self, None, None, mode, queue_size, overflow)
+        self.replay = replay
+        self.drain_timeout = drain_timeout
+        self.finished = False
+
+    def shutdown(self):
+        self.replay.stop()
+        NetworkClient.shutdown(self)
+
+    def run(self, verbose=False):
+        try:
+            for tag, payload in self.replay:
+                if self.tags is not None and tag not in self.tags:
+                    continue
+                self.lock.acquire()
+                try:
+                    self._store_timed([(tag, payload)], time.monotonic())
+                    self.data_ready.notify_all()
+                finally:
+                    self.lock.release()
+                if self._shutdown:
+                    break
+        finally:
+            self.finished = True
+            # let the consumer drain what is left, then stop it
+            self.wait_drained()
+            self.shutdown()
+
+    def wait_drained(self, timeout=None):
+        """Wait until the consumer released everything, True if it did.
+
+        Gives up after `timeout`, or when the consumer released nothing in
+        drain_timeout seconds, it may be gone.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.new_data and not self._shutdown:
+                wait = self.drain_timeout
+                if end is not None:
+                    wait = min(wait, end - time.monotonic())
+                    if wait <= 0:
+                        break
+                # release_data notifies not_full
+                if not self.not_full.wait(wait):
+                    if end is None or time.monotonic() < end:
+                        logging.warning("replay not drained, the consumer released nothing for %s s",
+                                        self.drain_timeout)
+                    break
+            return not self.new_data
@@ -0,0 +1,266 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serial link to the arduino
+"""
+
+from ctypes import Structure, c_byte, sizeof, memmove
+from functools import reduce
+from operator import xor
+import ctypes
+import logging
+import queue
+import threading
+import time
+
+
+class Datagram(Structure):
+    """Base of the arduino datagrams, the last field is the XOR of all
+    the bytes before it"""
+
+    def _bytes(self):
+        # byte view over the structure, made once per instance
+        try:
+            return self._view
+        except AttributeError:
+            self._view = memoryview(self).cast('B')
+            return self._view
+
+    def checksum(self):
+        self.check = reduce(xor, self._bytes()[:-1])
+
+    def serialize(self):
+        self.checksum()
+        return bytes(self)
+
+    def serialize_into(self, buf, offset=0):
+        """Checksum and copy into a preallocated bytearray"""
+        view = self._bytes()
+        self.check = reduce(xor, view[:-1])
+        end = offset + len(view)
+        buf[offset:end] = view
+        return end
+
+    def is_valid(self):
+        view = self._bytes()
+        return view[-1] == reduce(xor, view[:-1])
+
+    @classmethod
+    def scan(cls, data, start=0):
+        """Find the valid datagrams in a raw byte stream.
+
+        Returns (datagrams, end, invalid). Parsing can resume at `end`, what
+        is before it was consumed or skipped. `invalid` counts headers with a
+        wrong checksum.
+        """
+        size = sizeof(cls)
+        found = []
+        invalid = 0
+        pos = start
+        with memoryview(data) as view:
+            n = len(view)
+            while True:
+                i = data.find(sync, pos)
+                if i < 0:
+                    # a trailing header1 may start a datagram
+                    pos = n - 1 if n > pos and view[n - 1] == header1 else n
+                    break
+                if n - i < size:
+                    pos = i
+                    break
+                end = i + size
+                if view[end - 1] == reduce(xor, view[i:end - 1]):
+                    found.append(cls.from_buffer_copy(data, i))
+                    pos = end
+                else:
+                    invalid += 1
+                    pos = i + 1
+        return found, pos, invalid
+
+header1 = 0xaa #1010 1010
+header2 = 0x50 #0101 0000 
+sync = bytes([header1, header2])
+
+class DownstreamDatagram(Datagram):
+    #Matches simple arduino struct
+    _fields_ = [
+        ("header1", c_byte),
+        ("header2", c_byte),
+        ("screen", c_byte*8),
+        ("dots", c_byte), 
+        ("ledrevs", c_byte),
+        ("fuel", c_byte), 
+        ("grip", c_byte),
+        ("check", c_byte),
+    ]
+    _pack_=1
+    
+    def screen_from_string(self, string):
+        assert len(string) == 8
+        for i, c in enumerate(string.encode('ascii')):
+            self.screen[i] = c
+        
+    def string_from_screen(self):
+        return bytes(self.screen[:]).decode('ascii')
+
+class UpstreamDatagram(Datagram):
+    #Matches simple arduino upstream struct
+    _fields_ = [
+        ("header1", c_byte),
+        ("header2", c_byte),
+        ("buttons1", c_byte),
+        ("buttons2", c_byte), 
+        ("analog1", c_byte),
+        ("analog2", c_byte), 
+        ("check", c_byte),
+    ]
+    _pack_=1 
+    
+    def from_bytes(self, buf):
+        memmove(ctypes.byref(self), buf, sizeof(self))
+
+
+class FrameScheduler(object):
+    """Writes the newest downstream frame to a slow serial port.
+
+    submit only replaces the pending frame, so the frames in between are
+    coalesced. A frame equal to the last one written is not written again
+    and a new one is written only once the previous one had time to leave
+    the wire (10 bits per byte at `baudrate`, times `margin`) and the
+    output buffer of the port is empty. The display then never trails
+    behind a backlog in the OS buffer.
+
+    Call poll now and then, or submit, to write a pending frame.
+    """
+    def __init__(self, port, baudrate=None, margin=1.1):
+        self.port = port
+        if baudrate is None:
+            baudrate = getattr(port, 'baudrate', 9600)
+        self.baudrate = baudrate
+        self.margin = margin
+        self.pending = None
+        self.last = None
+        self.next_write = 0.0
+        self.written = 0
+        self.coalesced = 0
+        self.unchanged = 0
+
+    def frame_time(self, nbytes):
+        """Seconds the link needs for nbytes"""
+        return nbytes * 10.0 / self.baudrate * self.margin
+
+    def out_waiting(self):
+        # pyserial 3 only, older ports are taken as always drained
+        return getattr(self.port, 'out_waiting', 0)
+
+    def depth(self):
+        """Bytes not on the wire yet, pending frame and port buffer"""
+        pending = len(self.pending) if self.pending is not None else 0
+        return pending + self.out_waiting()
+
+    def submit(self, frame, now=None):
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = frame
+        return self.poll(now)
+
+    def poll(self, now=None):
+        """Write the pending frame if the link is free, True if written"""
+        frame = self.pending
+        if frame is None:
+            return False
+        if frame == self.last:
+            self.pending = None
+            self.unchanged += 1
+            return False
+        if now is None:
+            now = time.monotonic()
+        if now < self.next_write or self.out_waiting():
+            return False
+        self.port.write(frame)
+        self.pending = None
+        self.last = frame
+        self.written += 1
+        self.next_write = now + self.frame_time(len(frame))
+        return True
+
+
+class UpstreamReader(object):
+    """Reads UpstreamDatagrams from the port in its own thread.
+
+    Valid datagrams are put on the `events` queue, when it is full the
+    oldest event is dropped. After garbage or a bad checksum the stream is
+    resynchronized on the header1, header2 bytes. The port should have a
+    read timeout, it bounds how long stop takes.
+    """
+    def __init__(self, port, maxsize=64):
+        self.port = port
+        self.events = queue.Queue(maxsize)
+        self.size = sizeof(UpstreamDatagram)
+        self.buf = bytearray()
+        self.received = 0
+        self.invalid = 0
+        self.garbage = 0
+        self.dropped = 0
+        self.thread = None
+        self._stop = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self._stop = True
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while not self._stop:
+            try:
+                data = self.port.read(max(self.size, getattr(self.port, 'in_waiting', 0)))
+            except Exception as err:
+                logging.error("upstream read failed: %s", err)
+                break
+            if data:
+                self.feed(data)
+
+    def feed(self, data):
+        """Parse raw bytes, can be used without the thread"""
+        buf = self.buf
+        buf += data
+        found, end, invalid = UpstreamDatagram.scan(buf)
+        self.received += len(found)
+        self.invalid += invalid
+        self.garbage += end - len(found) * self.size
+        for datagram in found:
+            self._put(datagram)
+        del buf[:end]
+
+    def _put(self, datagram):
+        while True:
+            try:
+                self.events.put_nowait(datagram)
+                return
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
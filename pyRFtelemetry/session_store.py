@@ -0,0 +1,303 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Columnar store of the current session, indexed by lap
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from ctypes import sizeof
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from .RFstructs import TelemetryData, ScoreData, VehicleData
+
+# what to do with old laps over the memory budget
+SPILL = 'spill'
+DOWNSAMPLE = 'downsample'
+
+Rows = namedtuple('Rows', 'times data')
+
+
+class _Segment(object):
+    """Rows of one lap: the raw structures back to back, and their times.
+
+    Until it is closed the segment grows, what is read from it then is a
+    copy so that no view pins its buffers.
+    """
+    __slots__ = ('structure', 'lap', 'buf', 'times', 'step', 'spilled', 'closed')
+
+    def __init__(self, structure, lap):
+        self.structure = structure
+        self.lap = lap
+        self.buf = bytearray()
+        self.times = array('d')
+        self.step = 1
+        self.spilled = None
+        self.closed = False
+
+    def nbytes(self):
+        return len(self.buf) + 8 * len(self.times)
+
+    def data(self):
+        import numpy as np
+        if self.spilled:
+            return np.load(self.spilled, mmap_mode='r')
+        buf = self.buf if self.closed else bytes(self.buf)
+        return np.frombuffer(buf, dtype=self.structure.dtype())
+
+    def time_array(self):
+        import numpy as np
+        times = self.times if self.closed else array('d', self.times)
+        return np.frombuffer(times, dtype='<f8')
+
+
+class _Table(object):
+    """Segments of one structure, for one tag or one driver"""
+    def __init__(self, structure):
+        self.structure = structure
+        self.laps = []
+        self.segments = []
+        self.starts = []
+
+    def append(self, lap, payload, timestamp):
+        """Add a row, returns the segment when it started a new one"""
+        if not self.laps or self.laps[-1] != lap:
+            if self.segments:
+                self.segments[-1].closed = True
+            segment = _Segment(self.structure, lap)
+            # the segment first, a lap listed always has one
+            self.segments.append(segment)
+            self.starts.append(timestamp)
+            self.laps.append(lap)
+            new = segment
+        else:
+            new = None
+        segment = self.segments[-1]
+        segment.buf += payload
+        segment.times.append(timestamp)
+        return new
+
+    def lap(self, lap):
+        i = bisect_left(self.laps, lap)
+        if i == len(self.laps) or self.laps[i] != lap:
+            raise KeyError(lap)
+        segment = self.segments[i]
+        return Rows(segment.time_array(), segment.data())
+
+    def time_slice(self, start, end):
+        import numpy as np
+        first = max(bisect_right(self.starts, start) - 1, 0)
+        last = bisect_right(self.starts, end)
+        times, data = [], []
+        for segment in self.segments[first:last]:
+            a = bisect_left(segment.times, start)
+            b = bisect_right(segment.times, end)
+            if a < b:
+                times.append(segment.time_array()[a:b])
+                data.append(segment.data()[a:b])
+        if not data:
+            return Rows(np.empty(0, dtype='<f8'), np.empty(0, dtype=self.structure.dtype()))
+        return Rows(np.concatenate(times), np.concatenate(data))
+
+    def latest(self):
+        if not self.segments or not self.segments[-1].times:
+            return None
+        return self.segments[-1].data()[-1]
+
+
+class SessionStore(object):
+    """Keeps the TLMT, SCOR and VHCL of the session as columns.
+
+    Rows are stored per lap: TLMT by its lap_number, SCOR by the lap of the
+    player when it arrived and VHCL by driver and total_laps. lap() and
+    time_slice() find the rows by bisection and return them as NumPy
+    structured arrays, with the timestamps given to add.
+
+    Above memory_budget bytes the oldest finished laps are spilled to .npy
+    files in spill_dir (SPILL), or have every other row dropped (DOWNSAMPLE),
+    until the store fits again.
+
+    add and the queries hold `lock`, the store can be fed in one thread and
+    queried from others. The arrays returned stay valid after the lock is
+    released.
+    """
+    def __init__(self, memory_budget=256 << 20, policy=SPILL, spill_dir=None):
+        if policy not in (SPILL, DOWNSAMPLE):
+            raise ValueError("unknown policy: {}".format(policy))
+        self.memory_budget = memory_budget
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.telemetry = _Table(TelemetryData)
+        self.score = _Table(ScoreData)
+        self.vehicles = {}
+        self.player = None
+        self.lap_number = 0
+        self.nbytes = 0
+        self._order = []
+        self._spilled = 0
+        self.lock = threading.RLock()
+
+    def add(self, tag, payload, timestamp=None):
+        """Store a TLMT, SCOR or VHCL payload, other tags are ignored"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            if tag == b"TLMT":
+                lap = _lap_number(payload, _lap_offset)[0]
+                if lap < self.lap_number:
+                    # the laps start over, a new session
+                    self.clear()
+                self.lap_number = lap
+                self._added(self.telemetry.append(lap, payload, timestamp), len(payload))
+            elif tag == b"SCOR":
+                self._added(self.score.append(self.lap_number, payload, timestamp), len(payload))
+            elif tag == b"VHCL":
+                self._add_vehicles(payload, timestamp)
+            else:
+                return
+            if self.nbytes > self.memory_budget:
+                self._reduce()
+
+    def _add_vehicles(self, payload, timestamp):
+        size = sizeof(VehicleData)
+        pos = 4
+        for i in range(_count(payload)[0]):
+            is_player = payload[pos]
+            pos += 2
+            name = bytes(payload[pos + 1:pos + 1 + payload[pos]])
+            pos += 1 + payload[pos]
+            pos += 1 + payload[pos]
+            pos += 1 + payload[pos]
+            table = self.vehicles.get(name)
+            if table is None:
+                table = self.vehicles[name] = _Table(VehicleData)
+            if is_player:
+                self.player = name
+            lap = _total_laps(payload, pos)[0]
+            if table.laps and lap < table.laps[-1]:
+                self.vehicles[name] = table = _Table(VehicleData)
+                self._recount()
+            self._added(table.append(lap, payload[pos:pos + size], timestamp), size)
+            pos += size
+
+    def clear(self):
+        with self.lock:
+            self.telemetry = _Table(TelemetryData)
+            self.score = _Table(ScoreData)
+            self.vehicles = {}
+            self.player = None
+            self.lap_number = 0
+            self._recount()
+
+    def _recount(self):
+        segments = [s for table in self._tables() for s in table.segments]
+        self.nbytes = sum(s.nbytes() for s in segments)
+        self._order = [s for s in segments if not s.spilled]
+
+    def _added(self, segment, nbytes):
+        if segment is not None:
+            self._order.append(segment)
+        self.nbytes += nbytes + 8
+
+    def _reduce(self):
+        # only finished laps, the last segment of each table still grows
+        while self.nbytes > self.memory_budget:
+            candidates = [s for s in self._order
+                          if s.closed and not s.spilled and len(s.times) > 1]
+            if not candidates:
+                break
+            if self.policy == SPILL:
+                self._spill(candidates[0])
+            else:
+                self._downsample(min(candidates, key=lambda s: s.step))
+        self._order = [s for s in self._order if not s.spilled]
+
+    def _spill(self, segment):
+        import numpy as np
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="rfsession")
+        self._spilled += 1
+        filename = os.path.join(self.spill_dir, "lap{}_{}.npy".format(segment.lap, self._spilled))
+        np.save(filename, segment.data())
+        self.nbytes -= len(segment.buf)
+        segment.buf = bytearray()
+        segment.spilled = filename
+
+    def _downsample(self, segment):
+        size = sizeof(segment.structure)
+        before = segment.nbytes()
+        buf = memoryview(segment.buf)
+        # the lock is held, no query sees buf and times out of step
+        segment.buf = bytearray().join(buf[i:i + size] for i in range(0, len(buf), 2 * size))
+        segment.times = segment.times[::2]
+        segment.step *= 2
+        self.nbytes -= before - segment.nbytes()
+
+    def _tables(self):
+        return [self.telemetry, self.score] + list(self.vehicles.values())
+
+    def _table(self, tag, driver):
+        if tag == b"TLMT":
+            return self.telemetry
+        elif tag == b"SCOR":
+            return self.score
+        elif tag == b"VHCL":
+            return self.vehicles[self.player if driver is None else driver]
+        raise ValueError("not stored: {}".format(tag))
+
+    def laps(self, tag=b"TLMT", driver=None):
+        """Lap numbers stored, driver (bytes) defaults to the player for VHCL"""
+        with self.lock:
+            return list(self._table(tag, driver).laps)
+
+    def lap(self, lap, tag=b"TLMT", driver=None):
+        """Rows(times, data) of one lap, KeyError if it is not stored"""
+        with self.lock:
+            return self._table(tag, driver).lap(lap)
+
+    def time_slice(self, start, end, tag=b"TLMT", driver=None):
+        """Rows(times, data) with start <= time <= end"""
+        with self.lock:
+            return self._table(tag, driver).time_slice(start, end)
+
+    def drivers(self):
+        with self.lock:
+            return list(self.vehicles)
+
+    def best_sectors(self):
+        """driver -> (best_sector1, best_sector2, best_lap_time) as the
+        game reports them in the latest VHCL"""
+        best = {}
+        with self.lock:
+            for name, table in self.vehicles.items():
+                row = table.latest()
+                if row is not None:
+                    best[name] = (float(row['best_sector1']), float(row['best_sector2']),
+                                  float(row['best_lap_time']))
+        return best
+
+
+_lap_number = struct.Struct("<i").unpack_from
+_lap_offset = TelemetryData.lap_number.offset
+_count = struct.Struct("<i").unpack_from
+_total_laps = struct.Struct("<h").unpack_from
@@ -0,0 +1,115 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Latency histograms from socket receive to consumer dispatch
+"""
+
+import math
+
+# what is measured
+QUEUE_DELAY = 'queue'      # received in update -> released to a consumer
+AGE = 'age'                # received in update -> dispatch_message starts
+DECODE = 'decode'          # DataConsumer.assemble
+DISPATCH = 'dispatch'      # dispatch_message, decode included
+
+
+class Histogram(object):
+    """Durations in buckets of powers of two microseconds"""
+    buckets = 40
+
+    def __init__(self):
+        self.counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        bucket = math.frexp(us)[1] if us >= 1 else 0
+        self.counts[min(bucket, self.buckets - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the bucket holding that fraction"""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(2.0 ** bucket / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class TelemetryStats(object):
+    """Histograms keyed by (kind, consumer, tag), consumer is None for
+    the client side measurements"""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def add(self, kind, tag, seconds, consumer=None):
+        key = (kind, consumer, tag)
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(seconds)
+
+    def histogram(self, kind, tag, consumer=None):
+        return self.histograms.get((kind, consumer, tag))
+
+    def summary(self):
+        """Return {(kind, consumer, tag): summary} of every histogram"""
+        return dict((key, histogram.summary())
+                    for key, histogram in list(self.histograms.items()))
+
+    def reset(self):
+        self.histograms = {}
+
+    def report(self):
+        lines = []
+        for (kind, consumer, tag), s in sorted(self.summary().items(), key=str):
+            lines.append("{:8s} {:20s} {:6s} n={:<8d} mean {:8.3f} p50 {:8.3f} "
+                         "p99 {:8.3f} max {:8.3f} ms".format(
+                             kind, consumer or '-', _tag_name(tag),
+                             s['count'], s['mean'] * 1e3, s['p50'] * 1e3,
+                             s['p99'] * 1e3, s['max'] * 1e3))
+        return "\n".join(lines)
+
+
+def _tag_name(tag):
+    if isinstance(tag, tuple):
+        # (rig, tag) from a MultiClient or a Replay with sources
+        source, tag = tag
+        return "{}/{}".format(source, tag.decode('ascii', 'replace'))
+    return tag.decode('ascii', 'replace')
@@ -0,0 +1,202 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+World positions to distance along the lap, through a grid over the track
+"""
+
+from collections import namedtuple
+import math
+
+from .RFstructs import TelemetryData
+
+Location = namedtuple('Location', 'segment distance offset')
+
+# cells whose block of the distance table is computed at once
+_CHUNK = 1 << 22
+
+
+class TrackIndex(object):
+    """The line driven in a recorded lap, as segments, with a uniform grid
+    over it to find the nearest segment of a position.
+
+    Positions are matched in the horizontal plane (x, z, y is up), the
+    distance along the lap is the path length in 3D, as LiveDelta counts
+    it. Every grid cell lists the segments that can be the nearest one for
+    a point inside it, so a lookup only measures those. Cells further than
+    `reach` from the track list none, positions there are measured against
+    all the segments, still exact but slower.
+    """
+    def __init__(self, points, distances, length, origin, cell_size, table, counts, reach):
+        self.points = points
+        self.distances = distances
+        self.length = length
+        self.origin = origin
+        self.cell_size = cell_size
+        self.table = table
+        self.counts = counts
+        self.reach = reach
+        self.shape = counts.shape
+        self._prepare()
+
+    def _prepare(self):
+        a = self.points[:-1, [0, 2]]
+        self._a = a
+        self._ab = self.points[1:, [0, 2]] - a
+        self._ab2 = (self._ab ** 2).sum(axis=1)
+        self._ab2[self._ab2 == 0] = 1.0
+        self._lengths = self.distances[1:] - self.distances[:-1]
+        self._flat_table = self.table.reshape(-1, self.table.shape[-1])
+        self._flat_counts = self.counts.reshape(-1)
+
+    @classmethod
+    def from_positions(cls, positions, cell_size=10.0, spacing=2.0, reach=50.0, closed=True):
+        """Build the index from the (n, 3) positions of one lap.
+
+        Points closer than `spacing` metres to the previous one kept are
+        left out. A closed track joins the last point to the first.
+        """
+        import numpy as np
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        keep = [0]
+        last = positions[0]
+        for i in range(1, len(positions)):
+            if np.sqrt(((positions[i] - last) ** 2).sum()) >= spacing:
+                keep.append(i)
+                last = positions[i]
+        points = positions[keep]
+        if closed:
+            points = np.vstack([points, points[:1]])
+        if len(points) < 2:
+            raise ValueError("not enough positions for a track")
+        steps = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+        distances = np.concatenate([[0.0], np.cumsum(steps)])
+        flat = points[:, [0, 2]]
+        origin = flat.min(axis=0) - reach
+        shape = tuple(int(n) for n in np.ceil((flat.max(axis=0) + reach - origin) / cell_size))
+        table, counts = _candidates(flat, origin, cell_size, shape, reach)
+        return cls(points, distances, float(distances[-1]), origin, float(cell_size),
+                   table, counts, float(reach))
+
+    @classmethod
+    def from_rows(cls, telemetry, **kwargs):
+        """Build from TLMT rows of one lap, as a SessionStore gives them"""
+        return cls.from_positions(telemetry['position'], **kwargs)
+
+    @classmethod
+    def from_recording(cls, recording, lap, source=0, **kwargs):
+        """Build from the TLMT records of a lap of a RecordingReader"""
+        payloads = [payload for tag, timestamp, record_source, payload
+                    in recording.lap_records(lap, source, tags=[b"TLMT"])]
+        return cls.from_rows(TelemetryData.from_payloads(payloads), **kwargs)
+
+    def save(self, filename):
+        import numpy as np
+        np.savez(filename, points=self.points, distances=self.distances, table=self.table,
+                 counts=self.counts,
+                 meta=np.array([self.length, self.origin[0], self.origin[1],
+                                self.cell_size, self.reach]))
+
+    @classmethod
+    def load(cls, filename):
+        import numpy as np
+        with np.load(filename) as saved:
+            length, x, z, cell_size, reach = saved['meta']
+            return cls(saved['points'], saved['distances'], float(length), np.array([x, z]),
+                       float(cell_size), saved['table'], saved['counts'], float(reach))
+
+    def locate(self, positions):
+        """Location(segment, distance, offset) arrays for (n, 3) positions:
+        the nearest segment, the distance along the lap at the closest point
+        of it and how far from the line the position is.
+
+        A whole VHCL frame is located at once with grid['position'] of a
+        VehicleGrid.
+        """
+        import numpy as np
+        flat = np.asarray(positions, dtype=np.float64).reshape(-1, 3)[:, [0, 2]]
+        cells = np.floor((flat - self.origin) / self.cell_size).astype(np.intp)
+        inside = ((cells >= 0) & (cells < self.shape)).all(axis=1)
+        index = np.where(inside, cells[:, 0] * self.shape[1] + cells[:, 1], 0)
+        near = inside & (self._flat_counts[index] > 0)
+        segment = np.empty(len(flat), dtype=np.intp)
+        t = np.empty(len(flat))
+        d2 = np.empty(len(flat))
+        if near.any():
+            segment[near], t[near], d2[near] = self._nearest(flat[near], self._flat_table[index[near]])
+        far = ~near
+        if far.any():
+            everything = np.broadcast_to(np.arange(len(self._a)), (int(far.sum()), len(self._a)))
+            segment[far], t[far], d2[far] = self._nearest(flat[far], everything)
+        distance = self.distances[segment] + t * self._lengths[segment]
+        return Location(segment, distance, np.sqrt(d2))
+
+    def distance_at(self, position):
+        """Distance along the lap of a single position"""
+        return float(self.locate(position).distance[0])
+
+    def _nearest(self, flat, candidates):
+        import numpy as np
+        a = self._a[candidates]
+        ab = self._ab[candidates]
+        ap = flat[:, None, :] - a
+        t = np.clip((ap * ab).sum(axis=2) / self._ab2[candidates], 0.0, 1.0)
+        d2 = ((ap - t[..., None] * ab) ** 2).sum(axis=2)
+        best = d2.argmin(axis=1)
+        rows = np.arange(len(flat))
+        return candidates[rows, best], t[rows, best], d2[rows, best]
+
+
+def _segment_distances(points, a, ab, ab2):
+    import numpy as np
+    ap = points[:, None, :] - a
+    t = np.clip((ap * ab).sum(axis=2) / ab2, 0.0, 1.0)
+    return np.sqrt(((ap - t[..., None] * ab) ** 2).sum(axis=2))
+
+
+def _candidates(flat, origin, cell_size, shape, reach):
+    """Per cell the segments that can be nearest to a point inside it.
+
+    A point in the cell is at most half a diagonal from its centre, so its
+    nearest segment is at most nearest(centre) + diagonal from the centre.
+    Rows are padded with their first segment, a repeat changes nothing.
+    """
+    import numpy as np
+    a = flat[:-1]
+    ab = flat[1:] - a
+    ab2 = (ab ** 2).sum(axis=1)
+    ab2[ab2 == 0] = 1.0
+    diagonal = cell_size * math.sqrt(2)
+    i, j = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    centres = origin + (np.stack([i.ravel(), j.ravel()], axis=1) + 0.5) * cell_size
+    rows = []
+    step = max(1, _CHUNK // len(a))
+    for start in range(0, len(centres), step):
+        distances = _segment_distances(centres[start:start + step], a, ab, ab2)
+        nearest = distances.min(axis=1)
+        for cell_distances, cell_nearest in zip(distances, nearest):
+            if cell_nearest > reach:
+                rows.append(None)
+            else:
+                rows.append(np.flatnonzero(cell_distances <= cell_nearest + diagonal))
+    counts = np.array([0 if row is None else len(row) for row in rows], dtype=np.int32)
+    table = np.zeros((len(rows), max(1, counts.max())), dtype=np.int32)
+    for k, row in enumerate(rows):
+        if row is not None:
+            table[k, :len(row)] = row
+            table[k, len(row):] = row[0]
+    return table.reshape(shape + (-1,)), counts.reshape(shape)
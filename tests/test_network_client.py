@@ -0,0 +1,201 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+NetworkClient and MultiClient against the fake plugin server
+"""
+
+import threading
+import time
+
+import pytest
+
+from pyRFtelemetry.fake_plugin import FakePluginServer, SyntheticSource, stamp, stamp_offset
+from pyRFtelemetry.multi_client import MultiClient
+from pyRFtelemetry.network_client import (NetworkClient, LATEST, QUEUE, BLOCK, DROP_OLDEST,
+                                          DROP_NEWEST)
+
+
+def source(duration=0.5, rate=1000):
+    return SyntheticSource(rate=rate, grid_size=2, duration=duration)
+
+
+def start(server, client):
+    server_thread = server.start()
+    client_thread = threading.Thread(target=client.run)
+    client_thread.daemon = True
+    client_thread.start()
+    return server_thread, client_thread
+
+
+def stop(server, client, threads):
+    client.shutdown()
+    server.shutdown()
+    for thread in threads:
+        thread.join(5)
+
+
+def stamps(payloads):
+    return [stamp.unpack_from(payload, stamp_offset)[0] for payload in payloads]
+
+
+def drain(client, until, timeout=10.0):
+    """Release messages until `until` is set and nothing came for a while"""
+    messages = []
+    end = time.monotonic() + timeout
+    quiet = 0
+    while time.monotonic() < end and quiet < 3:
+        if client.wait_data(0.1):
+            messages.extend(client.release_messages())
+            quiet = 0
+        elif until.is_set():
+            quiet += 1
+    return messages
+
+
+def test_latest_keeps_the_newest_of_each_tag():
+    server = FakePluginServer(source(duration=1.2, rate=200), stamp=True)
+    client = NetworkClient(server.host, server.port, mode=LATEST)
+    threads = start(server, client)
+    try:
+        messages = drain(client, server.finished)
+    finally:
+        stop(server, client, threads)
+    tags = set(tag for tag, payload in messages)
+    # like the plugin, what comes before the first keep-alive is skipped
+    assert {b"TLMT", b"SCOR", b"VHCL", b"EDSS"} <= tags
+    tlmt = stamps(payload for tag, payload in messages if tag == b"TLMT")
+    # never older than what was released before
+    assert tlmt == sorted(tlmt)
+    assert 0 < len(tlmt) <= server.sent[b"TLMT"]
+
+
+def test_queue_delivers_everything_in_order():
+    server = FakePluginServer(source(), honor_keepalive=False, stamp=True)
+    client = NetworkClient(server.host, server.port, mode=QUEUE, queue_size=100000)
+    threads = start(server, client)
+    try:
+        messages = drain(client, server.finished)
+    finally:
+        stop(server, client, threads)
+    tlmt = stamps(payload for tag, payload in messages if tag == b"TLMT")
+    assert len(tlmt) == server.sent[b"TLMT"] == 500
+    assert tlmt == sorted(tlmt)
+    assert sum(client.dropped.values()) == 0
+
+
+@pytest.mark.parametrize('overflow', [DROP_OLDEST, DROP_NEWEST])
+def test_queue_overflow_drops(overflow):
+    server = FakePluginServer(source(), honor_keepalive=False, stamp=True)
+    client = NetworkClient(server.host, server.port, mode=QUEUE, queue_size=50,
+                           overflow=overflow)
+    started = time.monotonic()
+    threads = start(server, client)
+    try:
+        # nothing is released until the server is done
+        server.finished.wait(10)
+        time.sleep(0.3)
+        data = client.release_data()
+    finally:
+        stop(server, client, threads)
+    tlmt = stamps(data[b"TLMT"])
+    sent = server.sent[b"TLMT"]
+    assert len(tlmt) == 50
+    assert client.dropped[b"TLMT"] == sent - 50
+    assert client.high_water[b"TLMT"] == 50
+    assert tlmt == sorted(tlmt)
+    received = client.released_times[b"TLMT"]
+    assert len(received) == 50 and list(received) == sorted(received)
+    # 500 TLMT over 0.5 s, the first 50 or the last 50 are kept
+    if overflow == DROP_OLDEST:
+        assert tlmt[0] - started > 0.3
+    else:
+        assert tlmt[-1] - started < 0.2
+
+
+def test_queue_block_loses_nothing_with_a_slow_consumer():
+    server = FakePluginServer(source(), honor_keepalive=False, stamp=True)
+    client = NetworkClient(server.host, server.port, mode=QUEUE, queue_size=20,
+                           overflow=BLOCK)
+    threads = start(server, client)
+    tlmt = []
+    try:
+        end = time.monotonic() + 20
+        while len(tlmt) < 500 and time.monotonic() < end:
+            if client.wait_data(0.1):
+                tlmt.extend(payload for tag, payload in client.release_messages()
+                            if tag == b"TLMT")
+                time.sleep(0.01)
+    finally:
+        stop(server, client, threads)
+    assert len(tlmt) == 500
+    assert stamps(tlmt) == sorted(stamps(tlmt))
+    assert client.dropped[b"TLMT"] == 0
+
+
+def test_reconnects_after_the_server_restarts():
+    first = FakePluginServer(source(duration=None, rate=90))
+    port = first.port
+    client = NetworkClient(first.host, port, mode=LATEST)
+    threads = start(first, client)
+    try:
+        assert client.wait_data(5)
+        client.release_data()
+        first.shutdown()
+        threads[0].join(5)
+        # the client retries every second
+        time.sleep(0.5)
+        second = FakePluginServer(source(duration=None, rate=90), port=port)
+        second_thread = second.start()
+        try:
+            end = time.monotonic() + 10
+            while time.monotonic() < end:
+                if client.wait_data(0.5) and b"TLMT" in client.release_data():
+                    break
+            else:
+                pytest.fail("no data after the restart")
+        finally:
+            second.shutdown()
+            second_thread.join(5)
+    finally:
+        client.shutdown()
+        threads[1].join(5)
+
+
+def test_multi_client_survives_a_bad_rig():
+    server = FakePluginServer(source(duration=None, rate=90))
+    client = MultiClient(min_backoff=0.1)
+    bad = client.add_rig('no-such-host.invalid', 5556)
+    good = client.add_rig(server.host, server.port, name='good')
+    threads = start(server, client)
+    try:
+        seen = set()
+        end = time.monotonic() + 5
+        while time.monotonic() < end and (bad.backoff == 0 or ('good', b"TLMT") not in seen):
+            if client.wait_data(0.1):
+                seen.update(tag for tag, payload in client.release_messages())
+        assert threads[1].is_alive()
+        assert ('good', b"TLMT") in seen
+        assert good.connected and not bad.connected and bad.backoff > 0
+    finally:
+        stop(server, client, threads)
+
+
+def test_latency_benchmark_runs(capsys):
+    import benchmark_client
+    benchmark_client.run(90, QUEUE, 0.3, True)
+    assert "TLMT sent" in capsys.readouterr().out
@@ -0,0 +1,94 @@
+# pyRFtelemetry
+# Copyright (C) 2015 Alberto Gomez-Casado <albertogomcas@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Recordings and archives of what a client receives from the fake plugin server
+"""
+
+import struct
+import threading
+import time
+
+from pyRFtelemetry.archive import ArchiveReader, convert_recording
+from pyRFtelemetry.consumers import FileDump
+from pyRFtelemetry.fake_plugin import FakePluginServer, SyntheticSource, stamp, stamp_offset
+from pyRFtelemetry.network_client import NetworkClient, QUEUE
+from pyRFtelemetry.recording import RecordingReader, RecordingWriter
+from pyRFtelemetry.RFstructs import VehicleGrid
+
+
+def record(filename, duration=1.2):
+    server = FakePluginServer(SyntheticSource(rate=200, grid_size=3, duration=duration),
+                              honor_keepalive=False, stamp=True)
+    client = NetworkClient(server.host, server.port, mode=QUEUE, queue_size=100000)
+    dump = FileDump(client, filename)
+    server_thread = server.start()
+    client_thread = threading.Thread(target=client.run)
+    client_thread.daemon = True
+    client_thread.start()
+    dump_thread = threading.Thread(target=dump.main)
+    dump_thread.start()
+    try:
+        server.finished.wait(10)
+        time.sleep(0.3)
+    finally:
+        dump.stop()
+        dump_thread.join(5)
+        dump.close()
+        client.shutdown()
+        server.shutdown()
+        server_thread.join(5)
+    return server
+
+
+def test_file_dump_round_trip(tmp_path):
+    filename = str(tmp_path / "session.rftr")
+    server = record(filename)
+    with RecordingReader(filename) as reader:
+        records = list(reader)
+        counts = {}
+        for tag, timestamp, source, payload in records:
+            counts[tag] = counts.get(tag, 0) + 1
+        assert counts == server.sent
+        tlmt = [(timestamp, stamp.unpack_from(payload, stamp_offset)[0])
+                for tag, timestamp, source, payload in records if tag == b"TLMT"]
+    # receive times, not dispatch times: in order and after the send
+    times = [timestamp for timestamp, sent in tlmt]
+    assert times == sorted(times)
+    assert all(timestamp >= sent for timestamp, sent in tlmt)
+
+
+def test_archive_round_trip_keeps_empty_vhcl(tmp_path):
+    recording = str(tmp_path / "session.rftr")
+    archive = str(tmp_path / "session.rfta")
+    empty = struct.pack("<i", 0)
+    written = []
+    with RecordingWriter(recording) as writer:
+        for t, tag, payload in SyntheticSource(rate=90, grid_size=3, duration=10.0):
+            writer.write(tag, payload, t, "rig")
+            if tag == b"VHCL":
+                written.append((t, len(VehicleGrid(payload))))
+                writer.write(tag, empty, t + 0.001, "rig")
+                written.append((t + 0.001, 0))
+    convert_recording(recording, archive, chunk_rows=7)
+    with ArchiveReader(archive) as reader:
+        assert reader.sources == ["rig"]
+        vehicles = reader.read(b"VHCL")
+        assert list(vehicles.counts) == [count for t, count in written]
+        assert list(vehicles.frame_times) == [t for t, count in written]
+        assert (vehicles.times == vehicles.frame_times[vehicles.frame]).all()
+        assert len(reader.read(b"TLMT").times) == 900